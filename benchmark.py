@@ -0,0 +1,7 @@
+import mucoco.options as options
+
+if __name__ == "__main__":
+    # parse the arguments before importing torch/transformers so that --help and argument errors return immediately
+    args = options.get_benchmark_parser().parse_args()
+    from mucoco.benchmark import main
+    main(args)
\ No newline at end of file
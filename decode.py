@@ -1,4 +1,7 @@
-from mucoco.decode import cli_main
+import mucoco.options as options
 
 if __name__ == "__main__":
-    cli_main()
\ No newline at end of file
+    # parse the arguments before importing torch/transformers so that --help and argument errors return immediately
+    args = options.get_parser().parse_args()
+    from mucoco.decode import main
+    main(args)
\ No newline at end of file
@@ -1,23 +1,60 @@
 import logging
 import math
 import os
+import shutil
 import sys
+import tempfile
 import torch
 import numpy as np
 import torch.nn.functional as F
 import random
-import ot
+import time
+import functools
+import importlib.util
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from transformers import AutoTokenizer, AutoModel, AutoConfig
+try:
+    import ot
+except ImportError:
+    ot = None
+
+from transformers import AutoTokenizer, AutoModel, AutoConfig, AutoModelForCausalLM
 
 import mucoco.losses as lossbuilder
 import mucoco.options as options
 
-import bert_score
-from evaluation.similarity.test_sim import find_similarity as weiting_similarity_fn
-
-from fairseq.data.data_utils import collate_tokens
-from fairseq.models.roberta import RobertaModel
+from evaluation.formality.feature_cache import FeatureCache
+from evaluation.formality.score_store import ScoreStore
+
+# what every metric needs (python packages and models), only the dependencies of the requested metrics are imported and loaded
+METRIC_DEPENDENCIES = {
+    "bleu": ["sacrebleu"],
+    "bertscore": ["bert_score"],
+    "wmd": ["content"],
+    "moverscore": ["content"],
+    "cls_sim": ["content"],
+    "sts_sim": ["content"],
+    "wieting_sim": ["wieting", "nltk", "sentencepiece"],
+    "transfer": ["fairseq", "transfer"],
+    "fluency": ["fairseq", "fluency"],
+    "ppl": ["ppl"],
+}
+# the dependencies which are python packages, the others are models loaded in _main
+PACKAGE_DEPENDENCIES = ["sacrebleu", "bert_score", "nltk", "sentencepiece", "fairseq"]
+
+def metric_dependencies(evaluation_metrics):
+    """the dependencies of the metrics, fails before anything is loaded if one of their packages is not installed"""
+    unknown = evaluation_metrics.difference(METRIC_DEPENDENCIES)
+    if len(unknown) > 0:
+        raise ValueError(f"unknown evaluation metrics {sorted(unknown)}, expected some of {sorted(METRIC_DEPENDENCIES)}")
+    dependencies = set(dependency for metric in evaluation_metrics for dependency in METRIC_DEPENDENCIES[metric])
+
+    missing = [dependency for dependency in PACKAGE_DEPENDENCIES if dependency in dependencies and importlib.util.find_spec(dependency) is None]
+    if len(missing) > 0:
+        needed_by = sorted(metric for metric in evaluation_metrics if len(set(METRIC_DEPENDENCIES[metric]).intersection(missing)) > 0)
+        raise ImportError(f"{', '.join(needed_by)} need {', '.join(missing)} (not installed)")
+    return dependencies
 
 def detokenize(x):
     x = x.replace(" .", ".").replace(" ,", ",").replace(" !", "!").replace(" ?", "?").replace(" )", ")").replace("( ", "(")
@@ -28,150 +65,311 @@ def plot(scores, fname="hist.png", bins=100):
     plt.hist(scores, bins=bins)
     plt.savefig(fname)
 
-def transfer_classify(input1, model):
-    def label_fn(label):
-        return model.task.label_dictionary.string(
-            [label + model.task.target_dictionary.nspecial]
-        )
-    
-    input1 = [model.bpe.encode(detokenize(sd)) for sd in input1]
-    batch = collate_tokens(
-        [model.task.source_dictionary.encode_line("<s> " + sd + " </s>", append_eos=False) for sd in input1], pad_idx=1
-    )
-    batch = batch[:, :512]
-
-    with torch.no_grad():
-        predictions = model.predict('sentence_classification_head', batch.long())
-
-    prediction_labels = [label_fn(x.argmax(axis=0).item()) for x in predictions]
-    return prediction_labels
-
-def fluency_classify(input1, model):
+class BPECache(object):
+    """gpt2 bpe of the hypotheses, encoded once and shared by the fairseq classifiers (which use the same bpe)"""
+
+    def __init__(self, bpe):
+        self.bpe = bpe
+        self.cache = {}
+
+    def __call__(self, sentences):
+        encoded = []
+        for sentence in sentences:
+            if sentence not in self.cache:
+                self.cache[sentence] = self.bpe.encode(detokenize(sentence))
+            encoded.append(self.cache[sentence])
+        return encoded
+
+def classify(input1, model, bpe_cache, max_tokens=8192):
+    """
+    labels predicted by a fairseq roberta classifier, the sentences (truncated to 512 tokens) run longest first in micro
+    batches of at most max_tokens tokens including the padding
+    """
+    from fairseq.data.data_utils import collate_tokens
     def label_fn(label):
         return model.task.label_dictionary.string(
             [label + model.task.target_dictionary.nspecial]
         )
 
-    input1s = [model.bpe.encode(detokenize(inp)) for inp in input1]
-    batch = collate_tokens(
-        [model.task.source_dictionary.encode_line("<s> " + sd + " </s>", append_eos=False) for sd in input1s], pad_idx=1
-    )
-    batch = batch[:, :512]
-
-    with torch.no_grad():
-        predictions = model.predict('sentence_classification_head', batch.long())
-
-    # prediction_probs = [torch.exp(x).max(axis=0)[0].item() for x in predictions]
-    prediction_labels = [label_fn(x.argmax(axis=0).item()) for x in predictions]
+    tokens = [model.task.source_dictionary.encode_line("<s> " + sd + " </s>", append_eos=False).long()[:512] for sd in bpe_cache(input1)]
+    order = sorted(range(len(tokens)), key=lambda i: len(tokens[i]), reverse=True)
+
+    prediction_labels = [None] * len(tokens)
+    start = 0
+    while start < len(order):
+        # the first (longest) sentence of a micro batch sets its padded length
+        size = max(max_tokens // len(tokens[order[start]]), 1)
+        ids = order[start:start + size]
+        batch = collate_tokens([tokens[i] for i in ids], pad_idx=1)
+        with torch.no_grad():
+            predictions = model.predict('sentence_classification_head', batch)
+        for i, x in zip(ids, predictions):
+            prediction_labels[i] = label_fn(x.argmax(axis=0).item())
+        start += size
     return prediction_labels
 
-    # ncorrect += sum([1 if l1.lower() == l2.lower() else 0 for l1, l2 in zip(prediction_labels, lds)])
-
-    # nsamples += len(sds)
-
-    # for sd, ld, pld, ppd in zip(sds, lds, prediction_labels, prediction_probs):
-    #     sd1 = sd.strip()
-    #     sd1 = sd1.replace("<unk>", unk_bpe).strip()
-    #     argmax_results.append(pld.lower())
-    #     prediction_data[ld.lower()].append({
-    #         "sentence": model.bpe.decode(sd1),
-    #         "prediction": pld.lower(),
-    #         "prediction_prob": ppd,
-    #         "correct": ld.lower() == pld.lower()
-    #     })
-
-def wieting_sim(input1, input2, roberta):
-    # input1 = [roberta.bpe.decode(x) for x in input1]
-    # input2 = [roberta.bpe.decode(x) for x in input2]
-    return weiting_similarity_fn(input1, input2)
+def wieting_sim(input1, input2, scorer):
+    return scorer(input1, input2)
     
 
-def wmd(input1, input2, embed_lut, dist="cosine"):
-    input1_embs = embed_lut(input1)
-    input2_embs = embed_lut(input2)
-
+def _exact_emd(problem):
+    a, b, M = problem
+    return float(ot.emd2(a, b, M))
+
+class EMDSolver(object):
+    """
+    earth mover's distance between the (unpadded) tokens of each pair of sentences in a batch, with uniform weights over the tokens.
+    Only the distance is computed, not the transport plan.
+
+    exact: solves one POT problem per pair, in a process pool when workers > 0
+    sinkhorn: batched log-domain sinkhorn iterations on the device of the distances, stopping once the marginals are off by less than tol
+    """
+
+    def __init__(self, solver="exact", workers=0, reg=0.05, tol=1e-4, max_iter=1000):
+        if solver == "exact" and ot is None:
+            raise ImportError("the exact EMD solver needs POT (pip install pot), use --emd-solver sinkhorn otherwise")
+        self.solver = solver
+        self.workers = workers
+        self.reg = reg
+        self.tol = tol
+        self.max_iter = max_iter
+        self.pool = ProcessPoolExecutor(max_workers=workers) if solver == "exact" and workers > 0 else None
+
+    def __call__(self, pairwise_distance, mask1, mask2):
+        """pairwise_distance: ... x length1 x length2, mask1: ... x length1, mask2: ... x length2, returns a tensor of distances with the leading (batch) dimensions"""
+        batch_dims = pairwise_distance.size()[:-2]
+        pairwise_distance = pairwise_distance.reshape(-1, *pairwise_distance.size()[-2:])
+        mask1 = mask1.expand(*batch_dims, mask1.size(-1)).reshape(-1, mask1.size(-1))
+        mask2 = mask2.expand(*batch_dims, mask2.size(-1)).reshape(-1, mask2.size(-1))
+        if self.solver == "sinkhorn":
+            return self.sinkhorn(pairwise_distance, mask1, mask2).view(batch_dims)
+        return torch.tensor(self.exact(pairwise_distance, mask1, mask2)).view(batch_dims)
+
+    def exact(self, pairwise_distance, mask1, mask2):
+        M = pairwise_distance.data.double().cpu().numpy()
+        lengths1 = mask1.sum(dim=-1).tolist()
+        lengths2 = mask2.sum(dim=-1).tolist()
+
+        problems = []
+        for i in range(M.shape[0]):
+            l1, l2 = int(lengths1[i]), int(lengths2[i])
+            problems.append((np.full((l1,), 1./l1), np.full((l2,), 1./l2), np.ascontiguousarray(M[i, :l1, :l2])))
+
+        if self.pool is not None:
+            return list(self.pool.map(_exact_emd, problems, chunksize=max(len(problems) // self.workers, 1)))
+        return [_exact_emd(problem) for problem in problems]
+
+    def sinkhorn(self, pairwise_distance, mask1, mask2):
+        M = pairwise_distance.float()
+        mask1 = mask1.float()
+        mask2 = mask2.float()
+        loga = torch.log(mask1 / mask1.sum(dim=-1, keepdim=True))  # -inf on padding
+        logb = torch.log(mask2 / mask2.sum(dim=-1, keepdim=True))
+        # padded rows/columns get no mass
+        logK = (-M / self.reg).masked_fill(mask1.unsqueeze(2).eq(0) | mask2.unsqueeze(1).eq(0), -float("inf"))
+
+        f = torch.zeros_like(loga)
+        g = torch.zeros_like(logb)
+        for it in range(self.max_iter):
+            f = (loga - torch.logsumexp(logK + g.unsqueeze(1), dim=2)).masked_fill(mask1.eq(0), 0.)
+            g = (logb - torch.logsumexp(logK + f.unsqueeze(2), dim=1)).masked_fill(mask2.eq(0), 0.)
+            if it % 10 == 0 or it == self.max_iter - 1:
+                # after the update of g the column marginals are exact, check the rows
+                rows = torch.exp(torch.logsumexp(logK + f.unsqueeze(2) + g.unsqueeze(1), dim=2))
+                if (rows - mask1 / mask1.sum(dim=-1, keepdim=True)).abs().sum(dim=-1).max().item() < self.tol:
+                    break
+
+        T = torch.exp(logK + f.unsqueeze(2) + g.unsqueeze(1))
+        return (T * M).sum(dim=(1, 2))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def pairwise_distances(input1_embs, input2_embs, dist="cosine"):
+    """input1_embs: ... x length1 x hidden, input2_embs: ... x length2 x hidden (leading dimensions are broadcast), returns ... x length1 x length2"""
     if dist == "cosine":
         input1_embs = F.normalize(input1_embs, p=2, dim=-1)
         input2_embs = F.normalize(input2_embs, p=2, dim=-1)
-        pairwise_distance = 1. - (input1_embs.unsqueeze(2) * input2_embs.unsqueeze(1)).sum(dim=-1)
+        pairwise_distance = 1. - torch.matmul(input1_embs, input2_embs.transpose(-1, -2))
     else:
-        pairwise_distance = (input1_embs.unsqueeze(2) - input2_embs.unsqueeze(1))
-        pairwise_distance = torch.sqrt((pairwise_distance * pairwise_distance).sum(dim=-1))
+        input1_embs, input2_embs = torch.broadcast_tensors(input1_embs.unsqueeze(-2), input2_embs.unsqueeze(-3))
+        pairwise_distance = torch.norm(input1_embs - input2_embs, p=2, dim=-1)
+    return pairwise_distance
 
-    a = np.ones((input1_embs.size(1),))/input1_embs.size(1)
-    b = np.ones((input2_embs.size(1),))/input2_embs.size(1)
-    
-    M = pairwise_distance.data.cpu().numpy()
-    allT = []
-    alld = []
-    for i in range(input1.size(0)):
-        T = ot.emd(a, b, M[i])
-        d = np.sum(T * M[i])
-        allT.append(T)
-        alld.append(d)
-    
-    allT = np.concatenate(allT, axis=0)
+# the similarity metrics score a batch of hypotheses against all the references at once:
+# hypothesis tensors are batch_size x ..., reference tensors num_refs x batch_size x ... and the scores num_refs x batch_size
 
-    return alld
+def wmd(input1, mask1, input2, mask2, embed_lut, emd, dist="cosine"):
+    pairwise_distance = pairwise_distances(embed_lut(input1), embed_lut(input2), dist)
+    return emd(pairwise_distance, mask1, mask2)
 
 def bertscore(input_texts1, input_texts2, scorer):
-    return scorer.score(input_texts1, input_texts2)[-1].tolist()
+    """input_texts2: one list of references per hypothesis, bert_score takes the max over them"""
+    return scorer.score(input_texts1, input_texts2)[-1]
 
-def moverscore(input1, input2, model, dist="cosine"):
-    input1_features = model(input_ids=input1)[0] # get all embeddings
-    input2_features = model(input_ids=input2)[0]  # get all embeddings
-    
-    if dist == "cosine":
-        input1_features = F.normalize(input1_features, p=2, dim=-1)
-        input2_features = F.normalize(input2_features, p=2, dim=-1)
-        pairwise_distance = 1. - (input1_features.unsqueeze(2) * input2_features.unsqueeze(1)).sum(dim=-1)
-    else:
-        pairwise_distance = (input1_features.unsqueeze(2) - input2_features.unsqueeze(1))
-        pairwise_distance = torch.sqrt((pairwise_distance * pairwise_distance).sum(dim=-1))
-    
-    a = np.ones((input1.size(1),))/input1.size(1)
-    b = np.ones((input2.size(1),))/input2.size(1)
-    
-    M = pairwise_distance.data.cpu().numpy()
-    allT = []
-    alld = []
-    for i in range(input1.size(0)):
-        T = ot.emd(a, b, M[i])
-        d = np.sum(T * M[i])
-        allT.append(T)
-        alld.append(d)
-    
-    allT = np.concatenate(allT, axis=0)
+def moverscore(input1_features, mask1, input2_features, mask2, emd, dist="cosine"):
+    pairwise_distance = pairwise_distances(input1_features, input2_features, dist)
+    return emd(pairwise_distance, mask1, mask2)
 
-    return alld
-    #TODO: compute EMD
 
-
-def cls_similarity(input1, input2, model, metric="cosine"):
-    input1_features = model(input_ids=input1)[0][:, 0, :] #CLS token representation
-    input2_features = model(input_ids=input2)[0][:, 0, :]  #CLS token representation
-    
+def cls_similarity(input1_features, input2_features, metric="cosine"):
+    """input features: CLS token representations"""
     if metric=="cosine":
         sim = (F.normalize(input1_features, dim=-1, p=2) * F.normalize(input2_features, dim=-1, p=2)).sum(dim=-1)
     else:
         diff = (input1_features - input2_features)
-        sim = -(diff * diff).sum(dim=-1).sum(dim=-1)
+        sim = -(diff * diff).sum(dim=-1)
 
-    return sim.tolist()
-
-def sts_similarity(input1, input2, model):
-    input1_features = mean_pooling(model(input_ids=input1), attention_mask=torch.ones(input1.size(0), input1.size(1)).to(model.device))
-    input2_features = mean_pooling(model(input_ids=input2), attention_mask=torch.ones(input2.size(0), input2.size(1)).to(model.device))
+    return sim
 
+def sts_similarity(input1_features, input2_features):
+    """input features: mean pooled token representations"""
     sim = (F.normalize(input1_features, dim=-1, p=2) * F.normalize(input2_features, dim=-1, p=2)).sum(dim=-1)
-    return sim.tolist()
+    return sim
+
+def content_features(input_ids, attention_mask, model, kinds):
+    """features of the content model used by the similarity metrics: cls (CLS token), mean (mean pooled) and tokens (with their mask)"""
+    features = model(input_ids=input_ids, attention_mask=attention_mask)[0]
+    outputs = {}
+    if "cls" in kinds:
+        outputs["cls"] = features[:, 0, :]
+    if "mean" in kinds:
+        outputs["mean"] = mean_pooling((features,), attention_mask)
+    if "tokens" in kinds:
+        outputs["tokens"] = features
+        outputs["mask"] = attention_mask
+    return outputs
+
+def encode(sentences, tokenizer, device):
+    """tokenizes a batch of sentences into padded input ids and the corresponding attention mask"""
+    batch = tokenizer([detokenize(sent) for sent in sentences], padding=True, truncation=True, return_tensors="pt")
+    return batch["input_ids"].to(device), batch["attention_mask"].to(device)
+
+def length_sorted_order(source_dataset, target_datasets, ids=None):
+    """order in which to score the sentences (ids, all by default), longest first, so that each batch has sentences of similar lengths (i.e. little padding)"""
+    def length(i):
+        return len(source_dataset[i].split()) + max([len(target_dataset[i].split()) for target_dataset in target_datasets], default=0)
+    if ids is None:
+        ids = range(len(source_dataset))
+    return sorted(ids, key=length, reverse=True)
+
+def run_stage(stage, batch_size, order, score_fn):
+    """
+    scores all the sentences with score_fn in batches of batch_size following order, score_fn takes the ids of the sentences
+    of a batch and returns their scores for each metric of the stage, which are put back in the input order
+    """
+    start = time.time()
+    allscores = defaultdict(list)
+    for idx in range(0, len(order), batch_size):
+        for method, scores in score_fn(order[idx:idx + batch_size]).items():
+            allscores[method] += scores
+        if idx % 100 == 0:
+            print(f"{stage}:{idx}", end="...", flush=True)
+    print(f"{stage} done in {time.time() - start:.1f}s", flush=True)
+    return {method: restore_order(scores, order) for method, scores in allscores.items()}
+
+def restore_order(scores, order):
+    """puts scores computed following order back in the (increasing) order of the sentence ids"""
+    position = {i: n for n, i in enumerate(sorted(order))}
+    restored = [None] * len(scores)
+    for i, score in zip(order, scores):
+        restored[position[i]] = score
+    return restored
+
+def comparison_outfile(outfile, name, single, system=""):
+    """
+    report of one comparison set: outfile with {comparison} replaced by its name, or with the name before the extension.
+    {system} is replaced by the hypotheses file
+    """
+    outfile = outfile.replace("{system}", system)
+    if "{comparison}" in outfile:
+        return outfile.replace("{comparison}", name)
+    if single:
+        return outfile
+    root, ext = os.path.splitext(outfile)
+    return f"{root}.{name}{ext}"
+
+def table_columns(table):
+    columns = []
+    for row in table.values():
+        columns += [column for column in row if column not in columns]
+    return columns
+
+def print_table(table):
+    """one row per system, one column per comparison set and metric"""
+    columns = table_columns(table)
+    rows = [["system"] + columns] + [[system] + [f"{row[column]:.4f}" if column in row else "-" for column in columns] for system, row in table.items()]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns) + 1)]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)))
+
+def write_table(table, path):
+    """tab separated, one row per system"""
+    columns = table_columns(table)
+    with open(path, "w") as fout:
+        fout.write("\t".join(["system"] + columns) + "\n")
+        for system, row in table.items():
+            fout.write("\t".join([system] + [str(row.get(column, "")) for column in columns]) + "\n")
+
+def average_score(method, scores):
+    if method == "transfer":
+        scores = np.array(scores) == "formal"
+    elif method == "fluency":
+        scores = np.array(scores) == "acceptable"
+    else:
+        scores = np.array(scores)
+    return float(np.mean(scores.astype("float32")))
+
+def follow_lines(path, done_path, block_size, interval=5.0, timeout=None):
+    """
+    yields the lines of a file which is still being written (e.g. the predictions of decode.py) as they are completed, in
+    blocks of at least block_size lines, until done_path exists and the whole file has been read. Raises an error when
+    the marker reports a failure (decode.py writes its exit status in it) or when nothing was written for timeout seconds
+    """
+    offset = 0
+    buffer = ""
+    pending = []
+    last_write = time.time()
+    while True:
+        done = os.path.exists(done_path) # checked before reading, everything written before the marker is read below
+        if os.path.exists(path):
+            with open(path) as f:
+                f.seek(offset)
+                new = f.read()
+                offset = f.tell()
+            if new != "":
+                last_write = time.time()
+            buffer += new
+            lines = buffer.split("\n")
+            buffer = lines.pop() # the last line is not complete yet
+            pending += lines
+
+        if done:
+            if buffer != "":
+                pending.append(buffer)
+            if len(pending) > 0:
+                yield pending
+            with open(done_path) as f:
+                status = f.read().strip()
+            if status not in ["", "ok"]: # an empty marker is an ok
+                raise RuntimeError(f"{path} is incomplete, {done_path} reports that the decoding {status}")
+            return
+        if len(pending) >= block_size:
+            yield pending
+            pending = []
+        elif timeout is not None and time.time() - last_write > timeout:
+            raise TimeoutError(f"nothing was written to {path} for {timeout}s and {done_path} does not exist")
+        else:
+            time.sleep(interval)
 
 #Mean Pooling for content loss- Take attention mask into account for correct averaging
 def mean_pooling(model_output, attention_mask):
     token_embeddings = model_output[0] #First element of model_output contains all token embeddings
     input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-    sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1)
-    sum_mask = torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+    sum_embeddings = torch.sum(token_embeddings * input_mask_expanded, -2)
+    sum_mask = torch.clamp(input_mask_expanded.sum(-2), min=1e-9)
     return sum_embeddings / sum_mask
 
 
@@ -192,30 +390,50 @@ def get_symbols_to_strip_from_output(generator):
         return {generator.eos}
 
 
-def get_ppl(input, model, eos=-1):
-    if eos == -1:
-        model_output = model(input_ids=input[:, :-1])
-        lm_logits = model_output[0]
-        lm_logprobs = F.log_softmax(lm_logits, dim=-1)
-
-        # print(lm_logprobs.size())
-        # print(input[:, 1:].size())
-        nll = F.nll_loss(
-            lm_logprobs.squeeze(0), input[:, 1:].squeeze(0), reduction="none"
-        )
-
-        return nll.sum()
-    else:
-        model_output = model(input_ids=input)
-        lm_logits = model_output[0]
-        lm_logprobs = F.log_softmax(lm_logits, dim=-1)
-
-        nll = F.nll_loss(
-            lm_logprobs[:, :-1, :].squeeze(0), input[:, 1:].squeeze(0), reduction="none"
-        )
-        print(nll.size())
-        nll -= lm_logprobs[:, -1, eos]
-        return nll.sum()
+def encode_causal(sentences, tokenizer, device):
+    """tokenizes a batch of sentences for a causal lm: bos followed by the sentence, padded on the right, and the attention mask"""
+    bos = tokenizer.bos_token_id if tokenizer.bos_token_id is not None else tokenizer.eos_token_id
+    ids = [[bos] + tokenizer.encode(detokenize(sent), add_special_tokens=False) for sent in sentences]
+    max_length = max(len(x) for x in ids)
+    input_ids = torch.full((len(ids), max_length), tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0, dtype=torch.long)
+    attention_mask = torch.zeros((len(ids), max_length), dtype=torch.long)
+    for i, x in enumerate(ids):
+        input_ids[i, :len(x)] = torch.tensor(x)
+        attention_mask[i, :len(x)] = 1
+    return input_ids.to(device), attention_mask.to(device)
+
+def get_ppl(input_ids, attention_mask, model, max_length, stride):
+    """
+    negative log likelihood of every sentence of a padded batch under a causal lm (summed over its tokens, the first one is only
+    used as context) and the number of tokens it is summed over. Sentences longer than max_length are scored with a window of
+    max_length tokens sliding by stride tokens, every token is predicted once with at least max_length - stride tokens of context
+    """
+    length = input_ids.size(1)
+    nll = torch.zeros(input_ids.size(0), device=input_ids.device)
+    begin, scored = 0, 1
+    while True:
+        end = min(begin + max_length, length)
+        window_ids = input_ids[:, begin:end]
+        window_mask = attention_mask[:, begin:end]
+        lm_logits = model(input_ids=window_ids, attention_mask=window_mask)[0]
+        lm_logprobs = F.log_softmax(lm_logits[:, :-1].float(), dim=-1)
+        token_nll = -lm_logprobs.gather(-1, window_ids[:, 1:].unsqueeze(-1)).squeeze(-1)
+
+        # only the tokens which the previous windows did not predict
+        positions = torch.arange(begin + 1, end, device=input_ids.device)
+        mask = window_mask[:, 1:].float() * positions.ge(scored).float()
+        nll += (token_nll * mask).sum(dim=-1)
+        scored = end
+        if end == length:
+            break
+        begin += stride
+
+    return nll, attention_mask[:, 1:].sum(dim=-1)
+
+def corpus_perplexity(ppls, counts):
+    """perplexity of the whole corpus from the perplexities of the sentences and their number of tokens"""
+    ppls, counts = np.array(ppls, dtype=np.float64), np.array(counts, dtype=np.float64)
+    return float(np.exp((np.log(ppls) * counts).sum() / max(counts.sum(), 1.)))
 
 
 def _main(args, output_file):
@@ -232,46 +450,100 @@ def _main(args, output_file):
     use_cuda = torch.cuda.is_available() and not args.cpu
 
     evaluation_metrics = set(args.evaluation_metrics.split(","))
-
-    data_paths = args.data.split(",")
-    if len(data_paths) == 1:
-        source_data = data_paths[0]
-        target_datas = [data_paths[0]]
+    dependencies = metric_dependencies(evaluation_metrics)
+    logger.info(f"loading {sorted(dependencies)} for {sorted(evaluation_metrics)}")
+
+    data_paths = args.data.split(",") if args.data is not None else []
+    # several systems (hypotheses files) can be scored against the same references in one run, then --data only lists the
+    # references (not needed with --comparison)
+    if args.systems is not None:
+        systems = args.systems.split(",")
+        data_paths = [None] + data_paths
     else:
-        source_data = data_paths[0]
-        target_datas = data_paths[1:]
-
-    source_dataset = [l.strip() for l in open(source_data)]#load_dataset("text", data_files={"test": source_data}, cache_dir="hf_cache")
-    target_datasets = [[l.strip() for l in open(target_data)] for target_data in target_datas]#load_dataset("text", data_files={"test": target_data}, cache_dir="hf_cache")
-    
-
-    logger.info(f'dataset loaded with {len(source_dataset)} sentence pairs')
-
-    all_performance_metrics = {}
-    if "bleu" in evaluation_metrics:
+        systems = [data_paths[0]]
+    if len(systems) > 1:
+        if args.follow:
+            raise ValueError("--follow scores a single system")
+        if args.outfile is not None and "{system}" not in args.outfile:
+            raise ValueError("--outfile should contain {system} when scoring several systems")
+        if args.score_store is not None and "{system}" not in args.score_store:
+            raise ValueError("--score-store should contain {system} when scoring several systems")
+    source_data = systems[0]
+    # the hypotheses are compared with one or more named sets of references (e.g. the source sentences and the target style
+    # references), every model is loaded once and the metrics which only look at the hypotheses run once for all of them.
+    # without --comparison, the rest of --data is the only set, named after --match_with
+    comparisons = {}
+    if args.comparison is not None:
+        for comparison in args.comparison:
+            name, paths = comparison.split("=", 1)
+            comparisons[name] = paths.split(",")
+    elif len(data_paths) == 1:
+        comparisons[args.match_with] = [data_paths[0]]
+    else:
+        comparisons[args.match_with] = data_paths[1:]
+
+    # when following, the hypotheses are read as they are written
+    # the hypotheses of all the systems are concatenated and go through the models in shared batches, system_ids are the
+    # positions of the sentences of each system
+    source_dataset = []
+    system_ids = {}
+    for system in systems:
+        hypotheses = [l.strip() for l in open(system)] if not args.follow else []#load_dataset("text", data_files={"test": source_data}, cache_dir="hf_cache")
+        system_ids[system] = range(len(source_dataset), len(source_dataset) + len(hypotheses))
+        source_dataset += hypotheses
+    references = {name: [[l.strip() for l in open(target_data)] for target_data in target_datas] for name, target_datas in comparisons.items()}#load_dataset("text", data_files={"test": target_data}, cache_dir="hf_cache")
+    if len(systems) > 1:
+        for system in systems:
+            for name, target_datas in comparisons.items():
+                for target_data, target_dataset in zip(target_datas, references[name]):
+                    if len(target_dataset) != len(system_ids[system]):
+                        raise ValueError(f"{target_data} has {len(target_dataset)} sentences, {system} has {len(system_ids[system])}")
+    # aligned with source_dataset
+    target_datasets = {name: [target_dataset * len(systems) for target_dataset in target_datasets] for name, target_datasets in references.items()}
+
+    logger.info(f'dataset loaded with {len(source_dataset)} sentence pairs ({len(systems)} systems)')
+
+    # the metrics run as independent stages on a thread pool, each over the whole dataset with its own batch size
+    executor = ThreadPoolExecutor(max_workers=max(args.metric_workers, 1))
+    stage_batch_sizes = {}
+    if args.stage_batch_sizes is not None:
+        for stage_batch_size in args.stage_batch_sizes.split(","):
+            stage, batch_size = stage_batch_size.split("=")
+            stage_batch_sizes[stage] = int(batch_size)
+
+    def score_bleu(ids, target_datasets):
         import sacrebleu
-        bleu = sacrebleu.corpus_bleu([detokenize(sent) for sent in source_dataset], target_datasets)
-        bleuscore = bleu.score
-        print(f"method=bleu, average_score={bleuscore}")
-        all_performance_metrics["bleu"] = bleuscore
-
-    if len(set(evaluation_metrics).difference(set(['bertscore', 'wieting_sim', 'transfer', 'fluency']))) > 0:
+        return sacrebleu.corpus_bleu([detokenize(source_dataset[i]) for i in ids], target_datasets).score
+    if "sacrebleu" in dependencies and not args.follow:
+        # corpus level, runs while the models are loading
+        bleu_futures = {(system, name): executor.submit(score_bleu, system_ids[system], references[name]) for system in systems for name in comparisons}
+
+    # the huggingface models come from the local cache, without any network access with --offline
+    model_path = args.model
+    if "content" in dependencies:
         #only load these models if the evaluation metric requires it
-        model_path = args.model
-        tokenizer = AutoTokenizer.from_pretrained(model_path, cache_dir="cache")
-        content_config = AutoConfig.from_pretrained(model_path, cache_dir="cache")
-        content_model = AutoModel.from_pretrained(model_path, config=content_config, cache_dir="cache")
+        tokenizer = AutoTokenizer.from_pretrained(model_path, cache_dir="cache", local_files_only=args.offline)
+        content_config = AutoConfig.from_pretrained(model_path, cache_dir="cache", local_files_only=args.offline)
+        content_model = AutoModel.from_pretrained(model_path, config=content_config, cache_dir="cache", local_files_only=args.offline)
         content_model.eval()
+        if args.model_dtype == "fp16":
+            content_model.half()
+        if use_cuda:
+            content_model.cuda()
     
-    if "bertscore" in evaluation_metrics:
+    if "bert_score" in dependencies:
+        import bert_score
         scorer = bert_score.BERTScorer(lang="en", model_type=model_path, num_layers=10)
     
-    if "wieting_sim" in evaluation_metrics:
-        # os.environ['ROBERTA_BASE']="fairseq_cache/roberta.base"
-        # os.environ['TORCH_HOME']="./fairseq_cache"
-        wieting_roberta = torch.hub.load("pytorch/fairseq", "roberta.base", force_reload=True)
+    if "wieting" in dependencies:
+        from evaluation.similarity.test_sim import WietingSimilarity
+        # loaded on first use
+        wieting_scorer = WietingSimilarity(args.wieting_model, args.wieting_sp_model, batch_size=args.wieting_batch_size, workers=args.wieting_workers)
     
-    if "transfer" in evaluation_metrics:
+    if "fairseq" in dependencies:
+        from fairseq.models.roberta import RobertaModel
+
+    if "transfer" in dependencies:
         transfer_model = RobertaModel.from_pretrained(
             "/path/to/evaluation/models/formality_classifier",
             checkpoint_file='checkpoint_best.pt',
@@ -281,7 +553,7 @@ def _main(args, output_file):
             transfer_model.cuda()
             transfer_model.eval()
     
-    if "fluency" in evaluation_metrics:
+    if "fluency" in dependencies:
         fluency_model = RobertaModel.from_pretrained(
             '/path/to/evaluation/models/cola_classifier_fluency/',
             checkpoint_file='checkpoint_best.pt',
@@ -291,127 +563,258 @@ def _main(args, output_file):
             fluency_model.cuda()
             fluency_model.eval()
     
-    logger.info("model and tokenizers loaded")
-
-    if args.model_dtype == "fp16":
-        content_model.half()
-    if use_cuda:
-        content_model.cuda()
+    if "ppl" in dependencies:
+        ppl_tokenizer = AutoTokenizer.from_pretrained(args.ppl_model, cache_dir="cache", local_files_only=args.offline)
+        ppl_model = AutoModelForCausalLM.from_pretrained(args.ppl_model, cache_dir="cache", local_files_only=args.offline)
+        ppl_model.eval()
+        if args.model_dtype == "fp16":
+            ppl_model.half()
+        if use_cuda:
+            ppl_model.cuda()
+        ppl_max_length = args.ppl_max_length if args.ppl_max_length is not None else getattr(ppl_model.config, "n_positions", ppl_model.config.max_position_embeddings)
+        ppl_stride = args.ppl_stride if args.ppl_stride is not None else ppl_max_length // 2
+        # the first token of a window is only context, with stride == max_length it would never be predicted
+        if ppl_stride < 1 or ppl_stride >= ppl_max_length:
+            raise ValueError("--ppl-stride should be at least 1 and smaller than --ppl-max-length")
     
-    from collections import defaultdict
-    allscores = defaultdict(list)
-    c=0
-
-    for idx in range(0, len(source_dataset), args.batch_size):
-        source_tokenized = [tokenizer.encode(detokenize(sent), return_tensors="pt") for sent in source_dataset[idx:idx + args.batch_size]]
-        targets_tokenized = [[tokenizer.encode(detokenize(sent), return_tensors="pt") for sent in target_dataset[idx:idx + args.batch_size]] for target_dataset in target_datasets]
+    if "fairseq" in dependencies:
+        # both classifiers see the same bpe of the hypotheses
+        bpe_cache = BPECache((transfer_model if "transfer" in dependencies else fluency_model).bpe)
 
-        if len(source_tokenized) > 0 and len(targets_tokenized[0]) > 0:
-            source_tokenized = torch.cat(source_tokenized, dim=0).to(content_model.device)
-            targets_tokenized = [torch.cat(target_tokenized, dim=0).to(content_model.device) for target_tokenized in targets_tokenized]
-        else:
-            c+=args.batch_size
-            raise ValueError(f"one of source or target batch is empty")
-            continue
-
-        if "transfer" in evaluation_metrics:
-            transfers = transfer_classify(source_dataset[idx:idx + args.batch_size], transfer_model)
-            allscores["transfer"] += transfers
-        
-        if "fluency" in evaluation_metrics:
-            fluencys = fluency_classify(source_dataset[idx:idx + args.batch_size], fluency_model)
-            allscores["fluency"] += fluencys
-
-        if "bertscore" in evaluation_metrics:
-            bestscores = [0. for i in range(args.batch_size)]
-            for target_dataset in target_datasets:
-                scores = bertscore(source_dataset[idx:idx + args.batch_size], target_dataset[idx:idx + args.batch_size], scorer)
-                for i in range(len(scores)):
-                    scores[i] = max(bestscores[i], scores[i])
-                bestscores = scores
-            allscores["bertscore"] += bestscores
-        
-        if "wmd" in evaluation_metrics:
-            bestscores = [100000. for i in range(args.batch_size)]
-            for target_tokenized in targets_tokenized:
-                scores = wmd(source_tokenized, target_tokenized, content_model.get_input_embeddings())
-                for i in range(len(scores)):
-                    scores[i] = min(bestscores[i], scores[i])
-                bestscores = scores
-            allscores['wmd'] += bestscores
-            
-        if "moverscore" in evaluation_metrics:
-            bestscores = [100000. for i in range(args.batch_size)]
-            for target_tokenized in targets_tokenized:
-                scores = moverscore(source_tokenized, target_tokenized, content_model)
-                for i in range(len(scores)):
-                    scores[i] = min(bestscores[i], scores[i])
-                bestscores = scores
-            allscores['moverscore'] += bestscores
-            
-        if "cls_sim" in evaluation_metrics:  
-            bestscores = [0. for i in range(args.batch_size)]
-            for target_tokenized in targets_tokenized:
-                scores = cls_similarity(source_tokenized, target_tokenized, content_model)
-                for i in range(len(scores)):
-                    scores[i] = max(bestscores[i], scores[i])
-                bestscores = scores
-            allscores['cls_sim'] += bestscores
-        
-        if "sts_sim" in evaluation_metrics:  
-            bestscores = [0. for i in range(args.batch_size)]
-            for target_tokenized in targets_tokenized:
-                scores = sts_similarity(source_tokenized, target_tokenized, content_model)
-                for i in range(len(scores)):
-                    scores[i] = max(bestscores[i], scores[i])
-                bestscores = scores
-            allscores['sts_sim'] += bestscores
-        
-        if "wieting_sim" in evaluation_metrics:
-            bestscores = [0. for i in range(args.batch_size)]
-            for target_dataset in target_datasets:
-                scores = wieting_sim(source_dataset[idx:idx + args.batch_size], target_dataset[idx:idx + args.batch_size], wieting_roberta)
-                for i in range(len(scores)):
-                    scores[i] = max(bestscores[i], scores[i])
-                bestscores = scores
-
-            allscores["weiting_sim"] += bestscores
-        
-        if idx % 100 == 0:
-            print(idx, end="...", flush=True)
-
-    for method, scores in allscores.items():
-        # scores_ = scores
-        if method == "transfer":
-            scores_ = np.array(scores) == "formal"
-        elif method == "fluency":
-            scores_ = np.array(scores) == "acceptable"
-        else:
-            scores_ = np.array(scores)
-        x= 1.0 * np.mean(scores_.astype("float32"))
-        print(f"method={method}, average_score={x}")
-        all_performance_metrics[method] = 1.*np.mean(scores_.astype("float32"))
-        if args.match_with == "source":
-            outname = f"{source_data}.source{method}"
-        else:
-            outname = f"{source_data}.{method}"
-        with open(f"{source_data}.{method}", "w") as fout:
-            fout.write("\n".join([str(score) for score in scores]))
-    
-    
+    logger.info("model and tokenizers loaded")
 
-    if args.outfile is not None:
-        import json
-        with open(args.outfile, "w") as fout:
-            json.dump(all_performance_metrics, fout)
-        print(f"dumped the performance metrics to {args.outfile}")
+    if len(evaluation_metrics.intersection(["wmd", "moverscore"])) > 0:
+        emd = EMDSolver(args.emd_solver, workers=args.emd_workers, reg=args.sinkhorn_reg, tol=args.sinkhorn_tol, max_iter=args.sinkhorn_max_iter)
+
+    # content model features needed by the similarity metrics
+    kinds = [kind for metric, kind in [("cls_sim", "cls"), ("sts_sim", "mean"), ("moverscore", "tokens")] if metric in evaluation_metrics]
+    feature_cache = None
+    feature_cache_dir = args.feature_cache
+    if feature_cache_dir is None and len(systems) > 1 and len(kinds) > 0:
+        # the systems share the references, which are encoded once into a cache for this run
+        feature_cache_dir = tempfile.mkdtemp(prefix="feature_cache")
+    if feature_cache_dir is not None and len(kinds) > 0:
+        # the references are encoded once and reused by later evaluations, only what is missing from the cache goes through the model
+        feature_cache = FeatureCache(feature_cache_dir, model_path, args.model_dtype)
+        missing = feature_cache.missing(kinds, [sent for name in comparisons for target_dataset in references[name] for sent in target_dataset])
+        missing.sort(key=lambda sent: len(sent.split()), reverse=True)
+        logger.info(f"{len(missing)} reference sentences missing from the feature cache {feature_cache.path}")
+        with torch.no_grad():
+            for idx in range(0, len(missing), args.batch_size):
+                batch = missing[idx:idx + args.batch_size]
+                features = content_features(*encode(batch, tokenizer, content_model.device), content_model, kinds)
+                for kind in kinds:
+                    feature_cache.add(kind, batch, features[kind], features["mask"].sum(dim=-1).tolist() if kind == "tokens" else None)
+        feature_cache.flush()
+
+    def check_lengths(complete=True):
+        for name, target_datas in comparisons.items():
+            for target_data, target_dataset in zip(target_datas, target_datasets[name]):
+                if len(target_dataset) < len(source_dataset) or (complete and len(target_dataset) != len(source_dataset)):
+                    raise ValueError(f"{target_data} has {len(target_dataset)} sentences, expected {len(source_dataset)}")
+
+    # the stages which compare the hypotheses with references take the references of one comparison set
+
+    def score_transfer(batch_ids):
+        return {"transfer": classify([source_dataset[i] for i in batch_ids], transfer_model, bpe_cache, args.classifier_max_tokens)}
+
+    def score_fluency(batch_ids):
+        return {"fluency": classify([source_dataset[i] for i in batch_ids], fluency_model, bpe_cache, args.classifier_max_tokens)}
+
+    def score_bertscore(batch_ids, target_datasets):
+        scores = bertscore([source_dataset[i] for i in batch_ids], [[target_dataset[i] for target_dataset in target_datasets] for i in batch_ids], scorer)
+        return {"bertscore": scores.clamp(min=0.).tolist()}
+
+    def score_content(batch_ids, target_datasets):
+        """wmd, moverscore, cls_sim and sts_sim, which share the content model"""
+        source_batch = [source_dataset[i] for i in batch_ids]
+        target_sents = [target_dataset[i] for target_dataset in target_datasets for i in batch_ids]
+        batch_size = len(batch_ids)
+        num_refs = len(target_datasets)
+        scores = {}
+
+        source_tokenized, source_mask = encode(source_batch, tokenizer, content_model.device)
+        if "wmd" in evaluation_metrics or feature_cache is None:
+            # all the references of the batch are encoded together: num_refs x batch_size x length
+            targets_tokenized, targets_mask = encode(target_sents, tokenizer, content_model.device)
+            targets_tokenized = targets_tokenized.view(num_refs, batch_size, -1)
+            targets_mask = targets_mask.view(num_refs, batch_size, -1)
+
+        # the max (or min) over the references is taken on the num_refs x batch_size scores
+        with torch.no_grad():
+            if "wmd" in evaluation_metrics:
+                scores["wmd"] = wmd(source_tokenized, source_mask, targets_tokenized, targets_mask, content_model.get_input_embeddings(), emd).min(dim=0)[0].tolist()
+
+            if len(kinds) > 0:
+                # the hypotheses go through the content model once, and so do all the references (unless they are cached)
+                source_features = content_features(source_tokenized, source_mask, content_model, kinds)
+                if feature_cache is not None:
+                    dtype = next(iter(source_features.values())).dtype
+                    targets_features = {kind: feature_cache.vectors(kind, target_sents, content_model.device, dtype) for kind in kinds if kind != "tokens"}
+                    if "tokens" in kinds:
+                        targets_features["tokens"], targets_features["mask"] = feature_cache.tokens(target_sents, content_model.device, dtype)
+                else:
+                    targets_features = content_features(targets_tokenized.view(num_refs * batch_size, -1), targets_mask.view(num_refs * batch_size, -1), content_model, kinds)
+                targets_features = {kind: features.view(num_refs, batch_size, *features.size()[1:]) for kind, features in targets_features.items()}
+
+            if "moverscore" in evaluation_metrics:
+                scores["moverscore"] = moverscore(source_features["tokens"], source_mask, targets_features["tokens"], targets_features["mask"], emd).min(dim=0)[0].tolist()
+
+            if "cls_sim" in evaluation_metrics:
+                scores["cls_sim"] = cls_similarity(source_features["cls"], targets_features["cls"]).max(dim=0)[0].clamp(min=0.).tolist()
+
+            if "sts_sim" in evaluation_metrics:
+                scores["sts_sim"] = sts_similarity(source_features["mean"], targets_features["mean"]).max(dim=0)[0].clamp(min=0.).tolist()
+        return scores
+
+    def score_wieting(batch_ids, target_datasets):
+        source_batch = [source_dataset[i] for i in batch_ids]
+        bestscores = [0. for i in range(len(batch_ids))]
+        for target_dataset in target_datasets:
+            scores = wieting_sim(source_batch, [target_dataset[i] for i in batch_ids], wieting_scorer)
+            for i in range(len(scores)):
+                scores[i] = max(bestscores[i], scores[i])
+            bestscores = scores
+        return {"weiting_sim": bestscores}
+
+    def score_ppl(batch_ids):
+        input_ids, attention_mask = encode_causal([source_dataset[i] for i in batch_ids], ppl_tokenizer, ppl_model.device)
+        with torch.no_grad():
+            nll, count = get_ppl(input_ids, attention_mask, ppl_model, ppl_max_length, ppl_stride)
+        return {"ppl": torch.exp(nll / count.clamp(min=1)).tolist(), "ppl_tokens": count.tolist()}
+
+    # (stage, score function, metrics, whether it compares with the references)
+    stages = [
+        ("transfer", score_transfer, ["transfer"], False),
+        ("fluency", score_fluency, ["fluency"], False),
+        ("bertscore", score_bertscore, ["bertscore"], True),
+        ("content", score_content, ["wmd", "moverscore", "cls_sim", "sts_sim"], True),
+        ("wieting_sim", score_wieting, ["wieting_sim"], True),
+        ("ppl", score_ppl, ["ppl"], False),
+    ]
+    stages = [(stage, score_fn, references) for stage, score_fn, metrics, references in stages if len(evaluation_metrics.intersection(metrics)) > 0]
+
+    def score(ids):
+        """
+        runs the stages concurrently on the sentences ids, the ones which only look at the hypotheses once and the others once
+        per comparison set. returns the scores of every metric (in the order of the ids) for every comparison set
+        """
+        # batches are built from sentences of similar lengths and the scores put back in order at the end
+        hypotheses_order = length_sorted_order(source_dataset, [], ids)
+        futures = {}
+        for stage, score_fn, references in stages:
+            batch_size = stage_batch_sizes.get(stage, args.batch_size)
+            if not references:
+                futures[stage] = executor.submit(run_stage, stage, batch_size, hypotheses_order, score_fn)
+                continue
+            for name in comparisons:
+                order = length_sorted_order(source_dataset, target_datasets[name], ids)
+                score_references = functools.partial(score_fn, target_datasets=target_datasets[name])
+                futures[stage, name] = executor.submit(run_stage, stage if len(comparisons) == 1 else f"{stage}/{name}", batch_size, order, score_references)
+
+        # same order as when the metrics ran one after the other
+        scores = {name: {} for name in comparisons}
+        for stage, score_fn, references in stages:
+            for name in comparisons:
+                scores[name].update(futures[(stage, name) if references else stage].result())
+        return scores
+
+    if args.follow:
+        # scores the hypotheses while they are being decoded, decode.py creates the done marker once it has written all of them
+        allscores = {name: defaultdict(list) for name in comparisons}
+        done_marker = args.done_marker if args.done_marker is not None else f"{source_data}.done"
+        for lines in follow_lines(source_data, done_marker, args.follow_block, args.follow_interval, args.follow_timeout if args.follow_timeout > 0 else None):
+            ids = range(len(source_dataset), len(source_dataset) + len(lines))
+            source_dataset += [l.strip() for l in lines]
+            check_lengths(complete=False)
+            for name, comparison_scores in score(ids).items():
+                for method, scores in comparison_scores.items():
+                    allscores[name][method] += scores
+                print(f"{len(source_dataset)} sentences scored ({name}): " + ", ".join(f"{method}={average_score(method, scores)}" for method, scores in allscores[name].items() if method != "ppl_tokens"), flush=True)
+        check_lengths()
+        system_ids[source_data] = range(len(source_dataset))
+        if "sacrebleu" in dependencies:
+            bleu_futures = {(source_data, name): executor.submit(score_bleu, system_ids[source_data], references[name]) for name in comparisons}
+    else:
+        check_lengths()
+        allscores = score(range(len(source_dataset)))
 
-    print(f'ignore={c}')
+    if len(evaluation_metrics.intersection(["wmd", "moverscore"])) > 0:
+        emd.close()
+    if "wieting_sim" in evaluation_metrics:
+        wieting_scorer.close()
+    if feature_cache_dir is not None and args.feature_cache is None:
+        shutil.rmtree(feature_cache_dir)
+
+    # average scores of every system, "<comparison>/<metric>"
+    table = {}
+    for system in systems:
+        if len(systems) > 1:
+            print(f"system={system}")
+        ids = system_ids[system]
+        table[system] = {}
+
+        # all the per-sentence scores in one columnar file, every comparison set gets its own columns
+        score_store = ScoreStore(args.score_store.replace("{system}", system) if args.score_store is not None else f"{system}.scores.npz")
+
+        for name in comparisons:
+            if len(comparisons) > 1:
+                print(f"comparison={name}")
+            system_scores = {method: scores[ids.start:ids.stop] for method, scores in allscores[name].items()}
+
+            all_performance_metrics = {}
+            if "sacrebleu" in dependencies:
+                bleuscore = bleu_futures[system, name].result()
+                print(f"method=bleu, average_score={bleuscore}")
+                all_performance_metrics["bleu"] = bleuscore
+
+            for method, scores in system_scores.items():
+                if method == "ppl_tokens": # only kept for the corpus perplexity (and in the score store)
+                    continue
+                x = average_score(method, scores)
+                print(f"method={method}, average_score={x}")
+                all_performance_metrics[method] = x
+                if name == "source" or len(comparisons) > 1 and name != "reference":
+                    outname = f"{system}.{name}{method}"
+                else:
+                    outname = f"{system}.{method}"
+                with open(outname, "w") as fout:
+                    fout.write("\n".join([str(score) for score in scores]))
+
+            if "ppl" in system_scores:
+                # the average of ppl above is over the sentence perplexities
+                x = corpus_perplexity(system_scores["ppl"], system_scores["ppl_tokens"])
+                print(f"method=ppl_corpus, average_score={x}")
+                all_performance_metrics["ppl_corpus"] = x
+
+            score_store.update(name, system_scores)
+            print(f"dumped the per-sentence scores to {score_store.path} (columns {name}/<metric>)")
+
+            if args.outfile is not None:
+                import json
+                outfile = comparison_outfile(args.outfile, name, len(comparisons) == 1, system)
+                with open(outfile, "w") as fout:
+                    json.dump(all_performance_metrics, fout)
+                print(f"dumped the performance metrics to {outfile}")
+
+            for method, x in all_performance_metrics.items():
+                table[system][f"{name}/{method}"] = x
+
+    if len(systems) > 1:
+        print_table(table)
+        if args.systems_table is not None:
+            write_table(table, args.systems_table)
+            print(f"dumped the comparison of the systems to {args.systems_table}")
+
+    executor.shutdown()
 
 def cli_main():
-    parser = options.get_parser()
-    parser.add_argument("--pred")
+    parser = options.get_evaluation_parser()
     args = parser.parse_args()
+    if args.systems is None and args.data is None:
+        parser.error("--data (the hypotheses and the references) is required without --systems")
+    if args.systems is not None and args.data is None and args.comparison is None:
+        parser.error("--systems needs the references to compare the systems with, given with --comparison or --data")
     main(args)
 
 
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+import torch
+
+
+def sentence_hash(sentence):
+    return hashlib.sha1(sentence.encode("utf-8")).hexdigest()
+
+
+class FeatureCache(object):
+    """
+    Disk cache of the content model features of fixed sentence sets (e.g. the references), so that they are encoded once
+    and reused by every later evaluation. Features are stored per kind (cls: CLS token, mean: mean pooled, tokens: one
+    vector per token) in .npy shards which are memory-mapped when read, and an index maps the hash of every sentence to
+    its rows in a shard. Each model gets its own directory, keyed by the model path and dtype.
+
+    Args:
+        cache_dir: root directory of the cache
+        model_path: path or name of the content model
+        model_dtype: dtype the content model runs in
+    """
+
+    def __init__(self, cache_dir, model_path, model_dtype="fp32"):
+        key = hashlib.sha1(f"{model_path}|{model_dtype}".encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(cache_dir, key)
+        os.makedirs(self.path, exist_ok=True)
+        self.index_path = os.path.join(self.path, "index.json")
+        self.index = self._read_index()
+        self.shards = {}
+        self.pending = {}
+
+    def _read_index(self):
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                return json.load(f)
+        return {}
+
+    def missing(self, kinds, sentences):
+        """unique sentences for which at least one of the kinds is not cached yet"""
+        missing = []
+        seen = set()
+        for sentence in sentences:
+            h = sentence_hash(sentence)
+            if h not in seen and any(h not in self.index.get(kind, {}) for kind in kinds):
+                missing.append(sentence)
+            seen.add(h)
+        return missing
+
+    def add(self, kind, sentences, features, lengths=None):
+        """features: batch_size x hidden (cls, mean) or batch_size x length x hidden with the lengths of the sentences (tokens)"""
+        features = features.float().cpu().numpy()
+        pending = self.pending.setdefault(kind, [])
+        for i, sentence in enumerate(sentences):
+            rows = features[i:i + 1] if lengths is None else features[i, :lengths[i]]
+            pending.append((sentence_hash(sentence), rows))
+
+    def flush(self):
+        """writes the features added since the last flush to new shards and updates the index"""
+        if len(self.pending) == 0:
+            return
+
+        index = self._read_index() # keep what other evaluations added in the meantime
+        shard = uuid.uuid4().hex[:8]
+        for kind, pending in self.pending.items():
+            name = f"{kind}-{shard}.npy"
+            np.save(os.path.join(self.path, name), np.concatenate([rows for _, rows in pending], axis=0))
+            entries = index.setdefault(kind, {})
+            offset = 0
+            for h, rows in pending:
+                entries[h] = [name, offset, len(rows)]
+                offset += len(rows)
+
+        tmp_path = f"{self.index_path}.{shard}"
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+        self.index = index
+        self.pending = {}
+
+    def _rows(self, kind, sentence):
+        name, offset, length = self.index[kind][sentence_hash(sentence)]
+        if name not in self.shards:
+            self.shards[name] = np.load(os.path.join(self.path, name), mmap_mode="r")
+        return self.shards[name][offset:offset + length]
+
+    def vectors(self, kind, sentences, device, dtype=torch.float):
+        """pooled features (cls or mean) of the sentences: batch_size x hidden"""
+        features = np.concatenate([self._rows(kind, sentence) for sentence in sentences], axis=0)
+        return torch.from_numpy(features).to(device=device, dtype=dtype)
+
+    def tokens(self, sentences, device, dtype=torch.float):
+        """token features of the sentences padded to the longest one (batch_size x length x hidden) and the attention mask"""
+        rows = [self._rows("tokens", sentence) for sentence in sentences]
+        max_length = max(len(r) for r in rows)
+        features = np.zeros((len(rows), max_length, rows[0].shape[-1]), dtype=np.float32)
+        mask = np.zeros((len(rows), max_length), dtype=np.int64)
+        for i, r in enumerate(rows):
+            features[i, :len(r)] = r
+            mask[i, :len(r)] = 1
+        return torch.from_numpy(features).to(device=device, dtype=dtype), torch.from_numpy(mask).to(device)
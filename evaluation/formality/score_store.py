@@ -0,0 +1,64 @@
+import fcntl
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+class ScoreStore(object):
+    """
+    Per-sentence scores of one hypotheses file in a single columnar file: an "index" column with the sentence ids and one
+    column per comparison set and metric, named "<comparison>/<metric>" (e.g. "reference/cls_sim"). Every evaluation adds
+    (or replaces) its columns, and a column can be loaded on its own, e.g. np.load(path)["reference/cls_sim"].
+    Stored as .npz, or as parquet when the path ends in .parquet (needs pyarrow).
+
+    Args:
+        path: file of the store
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        # the lock is kept out of the output directory, one per store
+        key = hashlib.sha1(os.path.realpath(path).encode("utf-8")).hexdigest()[:16]
+        self.lock_path = os.path.join(tempfile.gettempdir(), f"score_store-{key}.lock")
+
+    def read(self, columns=None):
+        """the columns of the store (all by default) as numpy arrays"""
+        if not os.path.exists(self.path):
+            return {}
+        if self.parquet:
+            import pyarrow.parquet as pq
+            table = pq.read_table(self.path, columns=columns)
+            return {name: table.column(name).to_numpy() for name in table.column_names}
+        with np.load(self.path) as data:
+            return {name: data[name] for name in (columns if columns is not None else data.files)}
+
+    def _write(self, columns):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        if self.parquet:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            pq.write_table(pa.table(columns), tmp_path)
+        else:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **columns)
+        os.replace(tmp_path, self.path)
+
+    def update(self, comparison, allscores):
+        """adds the scores of every metric (lists with one score per sentence) against the comparison set"""
+        if len(allscores) == 0:
+            return
+        num_sentences = len(next(iter(allscores.values())))
+
+        # the evaluations against different comparison sets may run at the same time
+        with open(self.lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            columns = self.read()
+            if "index" in columns and len(columns["index"]) != num_sentences:
+                raise ValueError(f"{self.path} has scores for {len(columns['index'])} sentences, got {num_sentences}")
+            columns["index"] = np.arange(num_sentences)
+            for method, scores in allscores.items():
+                columns[f"{comparison}/{method}"] = np.array(scores)
+            self._write(columns)
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.nn.modules.distance import CosineSimilarity
 import numpy as np
 
@@ -28,23 +29,10 @@ class ParaModel(nn.Module):
 
     def torchify_batch(self, batch):
 
-        max_len = 0
-        for i in batch:
-            if len(i.embeddings) > max_len:
-                max_len = len(i.embeddings)
-
-        batch_len = len(batch)
-
-        np_sents = np.zeros((batch_len, max_len), dtype='int32')
-        np_lens = np.zeros((batch_len,), dtype='int32')
-
-        for i, ex in enumerate(batch):
-            np_sents[i, :len(ex.embeddings)] = ex.embeddings
-            np_lens[i] = len(ex.embeddings)
-
-        idxs, lengths, masks = torch.from_numpy(np_sents).long(), \
-                               torch.from_numpy(np_lens).float().long(), \
-                               self.compute_mask(torch.from_numpy(np_lens).long())
+        lengths = torch.tensor([len(ex.embeddings) for ex in batch], dtype=torch.long)
+        masks = self.compute_mask(lengths)
+        idxs = torch.zeros((len(batch), lengths.max().item()), dtype=torch.long)
+        idxs[masks.cpu().bool()] = torch.tensor([emb for ex in batch for emb in ex.embeddings], dtype=torch.long)
 
         if self.gpu >= 0:
             idxs = idxs.cuda()
@@ -74,4 +62,8 @@ class WordAveraging(ParaModel):
         word_embs = self.embedding(idxs)
         word_embs = word_embs * mask[:, :, None]
         g = word_embs.sum(dim=1) / lengths[:, None].float()
-        return g
\ No newline at end of file
+        return g
+
+    def encode_bag(self, idxs, offsets):
+        """same as encode, from the ids of all the sentences concatenated and the offset of each sentence (see sim_utils.lookup_ids)"""
+        return F.embedding_bag(idxs, self.embedding.weight, offsets, mode="mean")
\ No newline at end of file
@@ -1,27 +1,67 @@
 import io
+import os
 import numpy as np
 import torch
 
-def get_wordmap(textfile):
-    words={}
-    We = []
-    f = io.open(textfile, 'r', encoding='utf-8')
-    lines = f.readlines()
-    if len(lines[0].split()) == 2:
-        lines.pop(0)
-    ct = 0
-    for (n,i) in enumerate(lines):
-        word = i.split(' ', 1)[0]
-        vec = i.split(' ', 1)[1].split(' ')
-        j = 0
-        v = []
-        while j < len(vec):
-            v.append(float(vec[j]))
-            j += 1
-        words[word] = ct
-        ct += 1
-        We.append(v)
-    return words, np.array(We)
+def _parse_vectors(lines, dim):
+    """parses the vectors of a block of lines ("word v1 v2 ...") in one numpy call"""
+    words = []
+    vectors = []
+    for line in lines:
+        word, vector = line.rstrip("\n").split(' ', 1)
+        words.append(word)
+        vectors.append(vector)
+    We = np.fromstring(" ".join(vectors), dtype=np.float64, sep=" ")
+    if We.size != len(words) * dim:
+        raise ValueError(f"expected vectors of dimension {dim}")
+    return words, We.reshape(len(words), dim)
+
+def get_wordmap(textfile, cache=True, block_size=100000):
+    """
+    reads word vectors in text format (one word and its vector per line, optionally after a "count dim" header line).
+    the first call converts the file to a binary matrix (textfile.npy) and a vocabulary (textfile.vocab), which the
+    later calls memory-map instead of parsing the text again
+    """
+    matrix_path, vocab_path = textfile + ".npy", textfile + ".vocab"
+    if cache and os.path.exists(matrix_path) and os.path.exists(vocab_path) and os.path.getmtime(matrix_path) >= os.path.getmtime(textfile):
+        with io.open(vocab_path, 'r', encoding='utf-8') as f:
+            words = {word.rstrip("\n"): n for n, word in enumerate(f)}
+        return words, np.load(matrix_path, mmap_mode="r")
+
+    vocab = []
+    blocks = []
+    with io.open(textfile, 'r', encoding='utf-8') as f:
+        first = f.readline()
+        dim = len(first.split()) - 1
+        lines = []
+        if dim == 1: # header
+            dim = int(first.split()[1])
+        else:
+            lines.append(first)
+        for line in f:
+            lines.append(line)
+            if len(lines) == block_size:
+                block_words, block = _parse_vectors(lines, dim)
+                vocab += block_words
+                blocks.append(block)
+                lines = []
+        if len(lines) > 0:
+            block_words, block = _parse_vectors(lines, dim)
+            vocab += block_words
+            blocks.append(block)
+    We = np.concatenate(blocks, axis=0) if len(blocks) > 0 else np.zeros((0, dim))
+    words = {word: n for n, word in enumerate(vocab)}
+
+    if cache:
+        try:
+            np.save(matrix_path + ".tmp.npy", We)
+            with io.open(vocab_path + ".tmp", 'w', encoding='utf-8') as f:
+                f.write("".join(word + "\n" for word in vocab))
+            os.replace(vocab_path + ".tmp", vocab_path)
+            os.replace(matrix_path + ".tmp.npy", matrix_path)
+        except OSError: # e.g. read-only directory, just don't cache
+            pass
+    return words, We
 
 def get_minibatches_idx(n, minibatch_size, shuffle=False):
     idx_list = np.arange(n, dtype="int32")
@@ -42,21 +82,17 @@ def get_minibatches_idx(n, minibatch_size, shuffle=False):
 
     return zip(range(len(minibatches)), minibatches)
 
+def _length_mask(x, lengths):
+    lengths = torch.as_tensor(lengths, device=x.device)
+    return torch.arange(x.size(1), device=x.device)[None, :] < lengths[:, None]
+
 def max_pool(x, lengths, gpu):
-    out = torch.FloatTensor(x.size(0), x.size(2)).zero_()
-    if gpu >= 0:
-        out = out.cuda()
-    for i in range(len(lengths)):
-        out[i] = torch.max(x[i][0:lengths[i]], 0)[0]
-    return out
+    mask = _length_mask(x, lengths)
+    return x.masked_fill(~mask[:, :, None], -float("inf")).max(dim=1)[0]
 
 def mean_pool(x, lengths, gpu):
-    out = torch.FloatTensor(x.size(0), x.size(2)).zero_()
-    if gpu >= 0:
-        out = out.cuda()
-    for i in range(len(lengths)):
-        out[i] = torch.mean(x[i][0:lengths[i]], 0)
-    return out
+    mask = _length_mask(x, lengths).to(x.dtype)
+    return (x * mask[:, :, None]).sum(dim=1) / mask.sum(dim=1, keepdim=True)
 
 def lookup(words, w):
     w = w.lower()
@@ -78,4 +114,34 @@ class Example(object):
             if emb:
                 self.embeddings.append(emb)
         if len(self.embeddings) == 0:
-            self.embeddings.append(words['UUUNKKK'])
\ No newline at end of file
+            self.embeddings.append(words['UUUNKKK'])
+
+def lookup_ids(words, sentences):
+    """
+    bulk version of Example.populate_embeddings: maps the (space separated) words of all the sentences to their ids at once.
+    returns the ids of all the sentences concatenated and the offset of each sentence in them (the input of an embedding bag)
+    """
+    tokens = [sentence.lower().split() for sentence in sentences]
+    lengths = np.array([len(t) for t in tokens], dtype=np.int64)
+    flat = [w for t in tokens for w in t]
+    unk = words['UUUNKKK']
+
+    if len(flat) > 0:
+        vocab, inverse = np.unique(np.array(flat), return_inverse=True)
+        ids = np.array([words.get(w, 0) for w in vocab.tolist()], dtype=np.int64)[inverse.reshape(-1)]
+    else:
+        ids = np.zeros((0,), dtype=np.int64)
+    sentence_ids = np.repeat(np.arange(len(sentences)), lengths)
+
+    # like populate_embeddings, skip the unknown words (and the word with id 0), sentences left empty get UUUNKKK
+    keep = ids > 0
+    counts = np.bincount(sentence_ids[keep], minlength=len(sentences))
+    empty = np.nonzero(counts == 0)[0]
+    ids = np.concatenate([ids[keep], np.full((len(empty),), unk, dtype=np.int64)])
+    sentence_ids = np.concatenate([sentence_ids[keep], empty])
+    order = np.argsort(sentence_ids, kind="stable")
+    ids = ids[order]
+
+    counts = np.bincount(sentence_ids, minlength=len(sentences))
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    return torch.from_numpy(ids), torch.from_numpy(offsets)
\ No newline at end of file
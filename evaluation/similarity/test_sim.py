@@ -1,39 +1,98 @@
+import threading
+
 import torch
+from concurrent.futures import ProcessPoolExecutor
 from .sim_models import WordAveraging
-from .sim_utils import Example
-from nltk.tokenize import TreebankWordTokenizer
-import sentencepiece as spm
-
-tok = TreebankWordTokenizer()
-
-model = torch.load('/projects/tir5/users/sachink/embed-style-transfer/evaluation_models/weiting_sim/sim.pt')
-state_dict = model['state_dict']
-vocab_words = model['vocab_words']
-args = model['args']
-# turn off gpu
-model = WordAveraging(args, vocab_words)
-model.load_state_dict(state_dict, strict=True)
-sp = spm.SentencePieceProcessor()
-sp.Load('/projects/tir5/users/sachink/embed-style-transfer/evaluation_models/weiting_sim/sim.sp.30k.model')
-model.eval()
-
-
-def make_example(sentence, model):
-    sentence = sentence.lower()
-    sentence = " ".join(tok.tokenize(sentence))
-    sentence = sp.EncodeAsPieces(sentence)
-    wp1 = Example(" ".join(sentence))
-    wp1.populate_embeddings(model.vocab)
-    return wp1
+from .sim_utils import lookup_ids
+
+DEFAULT_MODEL = '/projects/tir5/users/sachink/embed-style-transfer/evaluation_models/weiting_sim/sim.pt'
+DEFAULT_SP_MODEL = '/projects/tir5/users/sachink/embed-style-transfer/evaluation_models/weiting_sim/sim.sp.30k.model'
+
+tok = None
+
+
+def treebank_tokenize(sentences):
+    global tok
+    if tok is None: # created on first use, also in the tokenization worker processes
+        from nltk.tokenize import TreebankWordTokenizer
+        tok = TreebankWordTokenizer()
+    return [" ".join(tok.tokenize(sentence.lower())) for sentence in sentences]
+
+
+class WietingSimilarity(object):
+    """
+    Wieting et al. paraphrase similarity (word averaging over sentencepiece tokens). The model and the sentencepiece model
+    are only loaded on the first call. Sentences are treebank-tokenized in a process pool of `workers` processes (in the
+    main process when 0), sentencepiece-encoded in one batched call and scored in chunks of `batch_size` pairs.
+    """
+
+    def __init__(self, model_path=None, sp_model_path=None, batch_size=1024, workers=0):
+        self.model_path = model_path if model_path is not None else DEFAULT_MODEL
+        self.sp_model_path = sp_model_path if sp_model_path is not None else DEFAULT_SP_MODEL
+        self.batch_size = batch_size
+        self.workers = workers
+        self.model = None
+        self.sp = None
+        self.pool = None
+        self.lock = threading.Lock() # the scorer can be shared by evaluation threads
+
+    def load(self):
+        with self.lock:
+            if self.model is None:
+                self._load()
+
+    def _load(self):
+        import sentencepiece as spm
+
+        checkpoint = torch.load(self.model_path)
+        model = WordAveraging(checkpoint['args'], checkpoint['vocab_words'])
+        model.load_state_dict(checkpoint['state_dict'], strict=True)
+        model.eval()
+        sp = spm.SentencePieceProcessor()
+        sp.Load(self.sp_model_path)
+        self.model, self.sp = model, sp
+
+    def tokenize(self, sentences):
+        if self.workers > 0:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            chunksize = max(len(sentences) // (4 * self.workers), 1)
+            chunks = [sentences[i:i + chunksize] for i in range(0, len(sentences), chunksize)]
+            sentences = [sentence for chunk in self.pool.map(treebank_tokenize, chunks) for sentence in chunk]
+        else:
+            sentences = treebank_tokenize(sentences)
+        return self.sp.encode(sentences, out_type=str)
+
+    def encode(self, sentences):
+        """one embedding bag over the ids of all the sentences"""
+        idxs, offsets = lookup_ids(self.model.vocab, [" ".join(pieces) for pieces in self.tokenize(sentences)])
+        device = self.model.embedding.weight.device
+        return self.model.encode_bag(idxs.to(device), offsets.to(device))
+
+    def __call__(self, s1, s2):
+        self.load()
+        scores = []
+        with torch.no_grad():
+            for i in range(0, len(s1), self.batch_size):
+                g1 = self.encode(s1[i:i + self.batch_size])
+                g2 = self.encode(s2[i:i + self.batch_size])
+                scores += self.model.cosine(g1, g2).tolist()
+        return scores
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+_default_scorer = None
 
 def find_similarity(s1, s2):
-    with torch.no_grad():
-        s1 = [make_example(x, model) for x in s1]
-        s2 = [make_example(x, model) for x in s2]
-        wx1, wl1, wm1 = model.torchify_batch(s1)
-        wx2, wl2, wm2 = model.torchify_batch(s2)
-        scores = model.scoring_function(wx1, wm1, wl1, wx2, wm2, wl2)
-        return [x.item() for x in scores]
+    global _default_scorer
+    if _default_scorer is None:
+        _default_scorer = WietingSimilarity()
+    return _default_scorer(s1, s2)
 
 # s1 = "the dog ran outsideddd."
 # s2 = "the puppy escape into the trees."
@@ -179,6 +179,11 @@ then
         --debug
 elif [[ "$debug" == "run_and_evaluate" ]]
 then
+    # the evaluation follows the predictions as they are decoded
+    rm -f $OUTDIR/prediction.txt $OUTDIR/prediction.txt.done
+    bash ./examples/style-transfer/evaluate.sh $DATA_DIR $OUTDIR/prediction.txt "" follow &
+    evaluation=$!
+
     python -W ignore -u decode.py\
         --data $DATA_DIR/informal:$DATA_DIR/formal.ref0\
         --additional-data $DATA_DIR/informal.paraphrase\
@@ -214,7 +219,7 @@ then
         --num-examples 0\
         --outfile $OUTDIR/prediction.txt
     
-    bash ./examples/style-transfer/evaluate.sh $DATA_DIR $OUTDIR/prediction.txt
+    wait $evaluation
 else
     bash ./examples/style-transfer/evaluate.sh $DATA_DIR $OUTDIR/prediction.txt
 fi
@@ -1,15 +1,28 @@
 DATA_DIR=$1
 hyp=$2
 suffix=$3
+follow=$4
+
+# with follow, the predictions are scored while decode.py is writing them (until it creates $hyp.done)
+evaluate() {
+    if [[ "$follow" == "follow" ]]
+    then
+        python evaluate.py "$@" --follow &
+    else
+        python evaluate.py "$@"
+    fi
+}
 
 refsource=$DATA_DIR/informal${suffix}
 refstarget=$DATA_DIR/formal.ref0${suffix},$DATA_DIR/formal.ref1${suffix},$DATA_DIR/formal.ref2${suffix},$DATA_DIR/formal.ref3${suffix}
 
-#deduplicate
-python evaluation/postprocess.py $hyp $hyp.dedup
-
-#evaluation wrt source
-python evaluate.py --data $hyp,$refsource --model sentence-transformers/roberta-base-nli-stsb-mean-tokens --tokenizer sentence-transformers/roberta-base-nli-stsb-mean-tokens --evaluation_metrics sts_sim,cls_sim,wieting_sim,transfer,fluency,bleu,ppl --outfile ${hyp}_source_results.json --match_with source
+#evaluation wrt source and reference in one pass, writes ${hyp}_source_results.json and ${hyp}_reference_results.json
+#hyp can be a comma separated list of predictions (e.g. from a sweep) scored in the same run, compared in systems_results.tsv
+evaluate --systems $hyp --comparison source=$refsource --comparison reference=$refstarget --model sentence-transformers/roberta-base-nli-stsb-mean-tokens --tokenizer sentence-transformers/roberta-base-nli-stsb-mean-tokens --evaluation_metrics sts_sim,cls_sim,wieting_sim,transfer,fluency,bleu,ppl --outfile {system}_{comparison}_results.json --systems-table $(dirname ${hyp%%,*})/systems_results.tsv --feature-cache $DATA_DIR/feature_cache
+wait
 
-#evaluation wrt reference
-python evaluate.py --data $hyp,$refstarget --model sentence-transformers/roberta-base-nli-stsb-mean-tokens --tokenizer sentence-transformers/roberta-base-nli-stsb-mean-tokens --evaluation_metrics sts_sim,cls_sim,wieting_sim,transfer,fluency,bleu,ppl --outfile ${hyp}_reference_results.json --match_with reference
\ No newline at end of file
+#deduplicate
+for system in ${hyp//,/ }
+do
+    python evaluation/postprocess.py $system $system.dedup
+done
@@ -2,8 +2,5 @@
 from __future__ import division, print_function
 
 import mucoco.losses
-import mucoco.utils
-
-import mucoco.debug
 
 import sys
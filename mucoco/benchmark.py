@@ -0,0 +1,204 @@
+import itertools
+import json
+import logging
+import time
+from types import SimpleNamespace
+
+import torch
+import transformers
+
+from mucoco.utils import TargetProbability, TargetEmbeddings, TargetSimplex, Optimizer, MemoryTracker
+from mucoco.decode import forward_step
+import mucoco.losses as lossbuilder
+import mucoco.options as options
+
+logger = logging.getLogger(__name__)
+
+# the tiny models share one fake vocabulary: ids 0-2 are <s>, <pad>, </s> and 3-5 are the special tokens used as segment ids by gpt2conditional
+TINY_TOKENIZER = SimpleNamespace(bos_token_id=0, pad_token_id=1, eos_token_id=2, additional_special_tokens_ids=[3, 4, 5])
+NUM_SPECIAL_TOKENS = 6
+
+
+def build_gpt2(vocab_size, args):
+    config = transformers.GPT2Config(vocab_size=vocab_size, n_embd=args.hidden_size, n_layer=args.num_layers, n_head=args.num_heads, n_positions=args.max_positions,
+        bos_token_id=0, pad_token_id=1, eos_token_id=2)
+    return transformers.GPT2LMHeadModel(config)
+
+
+def build_marian(vocab_size, args):
+    config = transformers.MarianConfig(vocab_size=vocab_size, d_model=args.hidden_size, encoder_layers=args.num_layers, decoder_layers=args.num_layers,
+        encoder_attention_heads=args.num_heads, decoder_attention_heads=args.num_heads, encoder_ffn_dim=4 * args.hidden_size, decoder_ffn_dim=4 * args.hidden_size,
+        max_position_embeddings=args.max_positions, pad_token_id=1, eos_token_id=2, decoder_start_token_id=1)
+    return transformers.MarianMTModel(config)
+
+
+def _roberta_config(vocab_size, args, **kwargs):
+    return transformers.RobertaConfig(vocab_size=vocab_size, hidden_size=args.hidden_size, num_hidden_layers=args.num_layers, num_attention_heads=args.num_heads,
+        intermediate_size=4 * args.hidden_size, max_position_embeddings=args.max_positions + 2, pad_token_id=1, bos_token_id=0, eos_token_id=2, **kwargs)
+
+
+def build_roberta_classifier(vocab_size, args):
+    return transformers.RobertaForSequenceClassification(_roberta_config(vocab_size, args, num_labels=2))
+
+
+def build_sentence_encoder(vocab_size, args):
+    return transformers.RobertaModel(_roberta_config(vocab_size, args))
+
+
+# which tiny model each loss is benchmarked with
+LOSS2MODEL = {
+    "gpt2conditional": build_gpt2,
+    "marianmt": build_marian,
+    "classification": build_roberta_classifier,
+    "usim": build_sentence_encoder,
+    "wmd": build_sentence_encoder,
+}
+
+
+def build_target(target_type, embed_lut, embed_scale, batch_size, length, vocab_size, device, args):
+    if target_type == "simplex":
+        return TargetSimplex(vocabsize=vocab_size, sent_length=length, batch_size=batch_size, device=device, temperature=args.decode_temperature, st=args.st,
+            sampling_strategy=args.sampling_strategy, sampling_strategy_k=args.sampling_strategy_k, embed_scales=[embed_scale])
+    elif target_type == "probs":
+        return TargetProbability(vocabsize=vocab_size, sent_length=length, batch_size=batch_size, device=device, st=args.st,
+            sampling_strategy=args.sampling_strategy, sampling_strategy_k=args.sampling_strategy_k, embed_scales=[embed_scale])
+    elif target_type == "embeds":
+        return TargetEmbeddings(embed_dim=embed_lut.embedding_dim, embed_lut=embed_lut, sent_length=length, batch_size=batch_size, device=device, st=args.st,
+            random_init=True, sampling_strategy=args.sampling_strategy, sampling_strategy_k=args.sampling_strategy_k, embed_scales=[embed_scale],
+            metric=args.metric, same_embed=args.same_embeds)
+    else:
+        raise ValueError("Wrong target_type")
+
+
+def benchmark_one(target_type, lossname, model, lossfn, batch_size, length, vocab_size, device, args):
+    """times args.optim_steps steps (forward, loss, backward and optimizer update, as in decode.py) of one configuration"""
+    use_cuda = device.type == "cuda"
+    embed_lut = model.get_input_embeddings()
+    if getattr(model, "get_decoder", None) is None:
+        embed_scale = 1.0
+    else:
+        embed_scale = getattr(model.get_decoder(), "embed_scale", 1.0)
+
+    source_batch = torch.randint(NUM_SPECIAL_TOKENS, vocab_size, (batch_size, args.source_length), device=device)
+    target_prefix = torch.empty((batch_size, 0), dtype=torch.long, device=device)
+
+    memory = MemoryTracker(enabled=True, cuda=use_cuda, model_params=list(model.parameters()))
+    memory.start_run(length=length)
+
+    outputs = build_target(target_type, embed_lut, embed_scale, batch_size, length, vocab_size, device, args)
+    optimizer = Optimizer.from_opt(outputs, args)
+    step_inputs = (outputs, [embed_lut], [lossfn], [lossname], source_batch, target_prefix, source_batch, [embed_scale], [1])
+
+    def step(activations=None):
+        _, _, _, losses_for_backward, _ = forward_step(*step_inputs, memory=activations)
+        optimizer.zero_grad(set_to_none=True)
+        model.zero_grad()
+        total_loss = losses_for_backward[0].sum()
+        memory.sample()
+        optimizer.backward(total_loss, retain_graph=True)
+        optimizer.step()
+
+    for _ in range(args.benchmark_warmup_steps):
+        step()
+
+    if use_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for i in range(args.optim_steps):
+        step(activations=memory.activations if i == 0 else None) #the saved tensor hooks slow things down, only the first timed step is instrumented
+    if use_cuda:
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+
+    memory.end_run(outputs, optimizer)
+    run = memory.runs[-1]
+    model.zero_grad(set_to_none=True)
+
+    # the process rss only grows over the configurations of a run, what a configuration itself needs is measured with the
+    # sizes of its tensors (and the allocator peak, reset for every configuration, on gpu)
+    tensor_memory = run["target_params"] + run["optimizer_state"] + run["activations"].get(lossname, 0)
+    result = {
+        "target_type": target_type,
+        "loss": lossname,
+        "batch_size": batch_size,
+        "length": length,
+        "vocab_size": vocab_size,
+        "source_length": args.source_length,
+        "steps": args.optim_steps,
+        "steps_per_sec": args.optim_steps / elapsed,
+        "ms_per_step": 1000 * elapsed / args.optim_steps,
+        "tensor_memory": tensor_memory,
+        "target_params": run["target_params"],
+        "optimizer_state": run["optimizer_state"],
+        "activations": run["activations"].get(lossname, 0),
+        "process_rss_max": run["cpu_rss_peak"], # running maximum of the process, not of this configuration
+    }
+    if use_cuda:
+        result["cuda_peak_memory"] = run["cuda_peak"]
+    return result
+
+
+def _key(result):
+    return tuple(result[k] for k in ["target_type", "loss", "batch_size", "length", "vocab_size", "source_length"])
+
+
+def main(args):
+    if args.seed is not None:
+        torch.manual_seed(args.seed)
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+    target_types = args.target_types.split(":")
+    losses = args.benchmark_losses.split(":") if args.benchmark_losses is not None else list(LOSS2MODEL.keys())
+    batch_sizes = [int(x) for x in args.batch_sizes.split(":")]
+    lengths = [int(x) for x in args.lengths.split(":")]
+    vocab_sizes = [int(x) for x in args.vocab_sizes.split(":")]
+
+    baseline = {}
+    if args.baseline is not None:
+        for line in open(args.baseline):
+            result = json.loads(line)
+            baseline[_key(result)] = result
+
+    outf = open(args.outfile, "a") if args.outfile is not None else None
+    setup = {"device": device.type, "torch": torch.__version__, "transformers": transformers.__version__, "optim": args.optim, "hidden_size": args.hidden_size, "num_layers": args.num_layers}
+
+    for lossname, vocab_size in itertools.product(losses, vocab_sizes):
+        if lossname not in LOSS2MODEL:
+            raise ValueError(f"no tiny model to benchmark {lossname} with, available: {', '.join(LOSS2MODEL)}")
+
+        torch.manual_seed(args.seed if args.seed is not None else 0)
+        model = LOSS2MODEL[lossname](vocab_size, args).to(device)
+        model.eval()
+        try:
+            lossfn = lossbuilder.build_loss(lossname, model, TINY_TOKENIZER, args)
+        except ImportError as e: #optional dependencies (e.g. POT for wmd)
+            print(f"skipping {lossname}: {e}")
+            continue
+
+        for target_type, batch_size, length in itertools.product(target_types, batch_sizes, lengths):
+            result = benchmark_one(target_type, lossname, model, lossfn, batch_size, length, vocab_size, device, args)
+            result.update(setup)
+
+            line = f"{target_type} {lossname} batch={batch_size} length={length} vocab={vocab_size}: {result['steps_per_sec']:.2f} steps/s, {result['ms_per_step']:.2f}ms/step, tensor memory {result['tensor_memory'] / 2 ** 20:.1f}MB"
+            if "cuda_peak_memory" in result:
+                line += f", cuda peak memory {result['cuda_peak_memory'] / 2 ** 20:.1f}MB"
+            if _key(result) in baseline:
+                line += f" ({result['steps_per_sec'] / baseline[_key(result)]['steps_per_sec']:.2f}x the baseline)"
+            print(line)
+
+            if outf is not None:
+                outf.write(json.dumps(result) + "\n")
+                outf.flush()
+
+        del model, lossfn
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    if outf is not None:
+        outf.close()
+
+
+def cli_main():
+    parser = options.get_benchmark_parser()
+    args = parser.parse_args()
+    main(args)
@@ -1,17 +1,23 @@
+import itertools
 import logging
 import math
 import os
 import sys
 import re
+import signal
+from contextlib import nullcontext
 import torch
 import numpy as np
 import transformers
 
 
 from transformers import AutoTokenizer, AutoConfig
-from sentence_transformers import SentenceTransformer, util
 
-from mucoco.utils import TargetProbability, TargetEmbeddings, TargetSimplex, Lambda, Optimizer, get_epsilon
+from mucoco.utils import TargetProbability, TargetEmbeddings, TargetSimplex, Lambda, Optimizer, CompiledStep, StepTimers, MemoryTracker, BudgetAllocator
+from mucoco.utils.timers import null_timer
+from mucoco.utils.memory import null_memory
+from mucoco.utils.misc import get_epsilon_schedule, epsilon_at
+from mucoco.utils.optim import make_learning_rate_decay_fn
 import mucoco.losses as lossbuilder
 import mucoco.options as options
 
@@ -36,6 +42,22 @@ def set_global_logging_level(level=logging.ERROR, prefices=[""]):
             logging.getLogger(name).setLevel(level)
 
 def main(args):
+    """decodes, then creates the done marker of --outfile with the exit status (ok or failed) even when decoding fails"""
+    def terminate(signum, frame):
+        sys.exit(128 + signum)
+    signal.signal(signal.SIGTERM, terminate) # killed: exit through the finally below
+
+    status = "failed"
+    try:
+        _main(args)
+        status = "ok"
+    finally:
+        if args.outfile is not None:
+            # evaluation --follow scores the predictions until the marker exists
+            with open(args.outfile + ".done", "w") as f:
+                f.write(status + "\n")
+
+def _main(args):
     logging.basicConfig(
         format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
         datefmt="%Y-%m-%d %H:%M:%S",
@@ -49,6 +71,9 @@ def main(args):
     if args.outfile is not None:
         outf = open(args.outfile, "w")
         outallsatf = open(args.outfile + ".allsat", "w")
+        # created once all the predictions are written, evaluation --follow scores them until then
+        if os.path.exists(args.outfile + ".done"):
+            os.remove(args.outfile + ".done")
 
     # Fix seed
     if args.seed is not None:
@@ -113,6 +138,7 @@ def main(args):
             name2config[model_path] = AutoConfig.from_pretrained(model_path, cache_dir=args.cache_dir)
 
             if model_types[i] == "sentence-transformer":
+                from sentence_transformers import SentenceTransformer #optional dependency, only imported when needed
                 name2model[model_path] = SentenceTransformer(model_path)
             else:
                 name2model[model_path] = getattr(transformers, model_types[i]).from_pretrained(model_path, config=name2config[model_path], cache_dir=args.cache_dir)
@@ -163,10 +189,22 @@ def main(args):
     
     logger.info("tokenizer(s), model(s) and loss function(s) loaded")
 
-    if args.model_dtype == "fp16": #while this is supported it doesn't work that well yet. Not recommended
-        for name, model in name2model.items():
-            model.half()
-        logger.info("changed everything to fp16")
+    # mixed precision: the models, the target parameters and the optimizer state stay in fp32, the forward passes (including the projection of the target onto the embedding tables) run under autocast.
+    # CPU autocast only supports bf16, so fp16 falls back to bf16 there. Only fp16 needs loss scaling (see GradScaler below)
+    amp_device = "cuda" if use_cuda else "cpu"
+    amp_dtype = None
+    if args.model_dtype == "fp16":
+        amp_dtype = torch.float16 if use_cuda else torch.bfloat16
+    elif args.model_dtype == "bf16":
+        amp_dtype = torch.bfloat16
+    if amp_dtype is not None:
+        logger.info(f"running forward passes under {amp_device} autocast with {amp_dtype}")
+
+    def autocast():
+        # torch.autocast needs torch >= 1.10, the default fp32 path doesn't enter it at all
+        if amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=amp_device, dtype=amp_dtype)
 
     #constraint thresholds. In the paper, we recommend to start with a high threshold value which is usually satisfied by default or easily satisfied and then decrease it gradually, otherwise weird adversarial solutions come up. This code supports different kinds of schedules for decreasing this threshold (usually just step or linear suffices). If no schedule is specified, it just remains the same as the original. 
     if args.epsilons is not None and args.epsilons != "none":
@@ -187,6 +225,9 @@ def main(args):
         decay_function = []
         epsilon_warmup_steps = []
         epsilon_cooldown_steps = []
+        epsilon_decay_functions = []
+    # the thresholds of all the constraints at every step, precomputed as a (steps x constraints) tensor
+    epsilon_schedule = get_epsilon_schedule(args.optim_steps, epsilons, min_epsilons, epsilon_warmup_steps, epsilon_cooldown_steps, epsilon_decay_functions)
     
     assert args.data is not None or args.additional_data is not None, "no data path has been provided"
     if args.data is not None:
@@ -212,6 +253,21 @@ def main(args):
     additional_dataset = [l.strip() for l in open(additional_data)]
     logger.info("Data loaded")
 
+    # per-phase timers of the optimization loop, reported per example and for the whole run
+    timers = StepTimers(enabled=args.timing_report is not None, cuda=use_cuda)
+    # memory usage per example and per length, attributed to the target, the optimizer state and the activations of each loss
+    memory = MemoryTracker(enabled=args.memory_report, cuda=use_cuda, model_params=[p for model in name2model.values() for p in model.parameters()], warning_fraction=args.memory_warning_fraction)
+
+    # how many optimization steps every example (and every length) gets, --optim-steps unless a dataset-level budget is set
+    num_examples = len(source_dataset) if args.num_examples <= 0 else min(args.num_examples, len(source_dataset))
+    budget = BudgetAllocator(math.ceil(num_examples / args.batch_size), args.optim_steps, total_steps=args.total_steps, time_budget=args.time_budget,
+        window=args.budget_window, min_progress=args.budget_min_progress)
+
+    compiled_step = None
+    if args.compile_step != "none":
+        # the compiled graphs are specialized per (batch size, length) and reused across examples with the same shape
+        compiled_step = CompiledStep(forward_step, backend=args.compile_step)
+
     source_batch, target_batch, additional_batch, for_predicted_source_batch, predicted_batch = [], [], [], [], []
     batch_size = args.batch_size # higher than 1 batch size does not work at the moment. It won't fit in a single GPU anyway 
     
@@ -253,7 +309,7 @@ def main(args):
             with primary_tokenizer.as_target_tokenizer():
                 eos_token_id=primary_tokenizer.eos_token_id
                 
-        with torch.no_grad():
+        with torch.no_grad(), timers("beam"):
             predicted_indices = clean_output(lossfns[0].generate(input_ids=source_indices, additional_ids=additional_indices)[0].tolist(), eos_token_id=eos_token_id, return_tensors=True) #some bug about length
             # print(additional_indices)
             print(source_text, additional_text, predicted_indices)
@@ -304,13 +360,14 @@ def main(args):
                 predictedlosses = []
                 for lossid in range(len(losses)):
                     lossname = losses[lossid]
-                    predicted_loss, predicted_lo =\
-                        lossfns[lossid].compute_gold_loss(
-                            (source_batch, predicted_batch), 
-                            additional_batch=additional_batch, 
-                            label_id=label_ids[lossid])
+                    with timers("beam"):
+                        predicted_loss, predicted_lo =\
+                            lossfns[lossid].compute_gold_loss(
+                                (source_batch, predicted_batch), 
+                                additional_batch=additional_batch, 
+                                label_id=label_ids[lossid])
                     
-                    predictedlosses.append(predicted_loss.data.cpu())
+                    predictedlosses.append(predicted_loss.data.cpu().view(-1)) #some gold losses squeeze the batch dimension away when the batch size is 1
                     predicted_loss = predicted_loss.sum().item()
                     total_predicted_loss += betas[lossid] * predicted_loss
 
@@ -325,6 +382,7 @@ def main(args):
                 predictedlosslists.append(predictedlosses)
                 if lossid > 0 and args.gold_loss_epsilons[lossid-1] == "true": #use the predicted loss as the threshold, mucoco has to beat it then
                     min_epsilons[lossid - 1] = predicted_loss
+                    epsilon_schedule = get_epsilon_schedule(args.optim_steps, epsilons, min_epsilons, epsilon_warmup_steps, epsilon_cooldown_steps, epsilon_decay_functions)
                 
                 lengthwise_best_prediction = [(beam_prediction, total_predicted_loss, predicted_allsat)]
                 skip = predicted_allsat
@@ -369,6 +427,9 @@ def main(args):
                     #another way to use this approach is train models which also compute loss on <pad> token and then predict the entire sentence including pad, it has shown to work in some of our experiments
                     length_range = [args.max_length]
 
+                # with --warm-start, the solution (and the multipliers) of a length initialize the next length
+                prev_outputs, prev_lambda = None, None
+                budget.start_example(len(length_range))
                 for sent_length_ in length_range:
                     # prefix_length is used to indicate if instead of predicting the entire sentence via optimization, we want to fix a prefix (of specified length) and predict the remaining suffix. We use part of the beam search prediction as the prefix. 
                     if args.prefix_length > 0:
@@ -457,22 +518,21 @@ def main(args):
                     else:
                         raise ValueError("Wrong target_type")
 
+                    if prev_outputs is not None and args.init not in ["source", "target"]:
+                        outputs.warm_start(prev_outputs, mode=args.warm_start)
+
                     if len(losses) > 1:
-                        lambda_ = Lambda(count=len(epsilons))
+                        lambda_ = Lambda(count=len(epsilons), lr=args.lambda_lr, lr_decay_fn=make_learning_rate_decay_fn(args))
                         if use_cuda:
                             lambda_.cuda()
+                            epsilon_schedule = epsilon_schedule.to(device)
+                        if prev_lambda is not None:
+                            lambda_.lambda_.data.copy_(prev_lambda.lambda_.data)
 
+                    memory.start_run(example=c, length=sent_length)
                     optimizer = Optimizer.from_opt(outputs, args)
                     # print(optimizer._optimizer.param_groups)
                     # input()
-                    if len(losses) > 1:
-                        old_optim = args.optim
-                        args.optim = "ascentsgd"
-                        old_lr = args.lr
-                        args.lr = args.lambda_lr
-                        optimizer_lambda = Optimizer.from_opt(lambda_, args)
-                        args.optim = old_optim
-                        args.lr = old_lr
 
                     best_loss = [None] * batch_size
                     best_allsat = [None] * batch_size
@@ -484,45 +544,31 @@ def main(args):
                     best_index = [-1 for i in range(batch_size)]
                     
                     scaler = None
-                    if args.model_dtype == "fp16" and args.fp16_source == "pytorch":
+                    if amp_dtype == torch.float16 and args.fp16_source == "pytorch":
                         scaler = torch.cuda.amp.GradScaler()
                 
                     for lossid, lossname in enumerate(losses):
                         losslists[lossid].append([])
 
                     broken=False
-                    for step in range(args.optim_steps):
+                    budget.start_run(length=sent_length)
+                    for step in itertools.count():
+                        if not budget.has_steps():
+                            break
                         try:
-                            with torch.cuda.amp.autocast():
-                                losses_for_backward = []
-                                logging_outputs = []
-
-                                pred_embeds, pred_tokens, pred_probs = outputs.forward_multiple(embed_luts)  # forward
-                                
-                                original_preds = None
-                                if len(pred_embeds) > 1:
-                                    original_preds = pred_embeds[1]
-
-                                for lossid, lossname in enumerate(losses):
-                                    lossvalue, logging_output =\
-                                        lossfns[lossid].compute_loss(
-                                            [source_batch, target_prefix], 
-                                            [pred_tokens, pred_embeds[0][lossid], pred_probs], 
-                                            additional_batch=additional_batch, 
-                                            embed_scale=embed_scales[lossid], 
-                                            label_id=label_ids[lossid],
-                                            original_preds=original_preds
-                                        )
+                            with autocast():
+                                step_inputs = (outputs, embed_luts, lossfns, lossabbr, source_batch, target_prefix, additional_batch, embed_scales, label_ids)
+                                if compiled_step is not None:
+                                    with timers("compiled_step"): #individual phases can't be timed inside the compiled graph
+                                        pred_embeds, pred_tokens, pred_probs, losses_for_backward, logging_outputs = compiled_step((batch_size, sent_length), *step_inputs, dynamic_inputs=(source_batch, additional_batch))
+                                else:
+                                    pred_embeds, pred_tokens, pred_probs, losses_for_backward, logging_outputs = forward_step(*step_inputs, timers=timers, memory=memory.activations)  # forward
 
+                                for lossid, lossvalue in enumerate(losses_for_backward):
                                     losslists[lossid][-1].append(lossvalue.sum().item())  #for logging
-                                    losses_for_backward.append(lossvalue)  # for backward
-                                    logging_outputs.append(logging_output)
                                 
                                 optimizer.zero_grad(set_to_none=True)
                                 outputs.zero_grad()
-                                if len(losses) > 1:
-                                    optimizer_lambda.zero_grad(set_to_none=True)
-                                    lambda_.zero_grad()
 
                                 for model in name2model.values():
                                     model.zero_grad()
@@ -535,34 +581,25 @@ def main(args):
                                         total_loss = total_loss + betas[sid] * losses_for_backward[sid]
                                         cur_epsilons.append(0.0)
                                 else:
-                                    total_loss = 0.0
                                     total_loss = losses_for_backward[0]
-                                    # total_loss_for_lambda = 0.0
                                     cur_epsilons = []
 
-                                    for sid in range(1, len(losses_for_backward)): #the secondary losses or constraints
-                                        cur_epsilon = get_epsilon(step, epsilons[sid-1], min_epsilons[sid-1], epsilon_warmup_steps[sid-1], epsilon_cooldown_steps[sid-1], epsilon_decay_functions[sid-1])
-                                        damp = args.dampness * (cur_epsilon - losses_for_backward[sid]).detach()
-
-                                        # closs_for_theta = lambda_.get_loss(sid - 1, damp, torch.clamp(cur_epsilon - losses_for_backward[sid], max=0.0))
-                                        mask = lambda_.get_mask(sid-1, damp)
-                                        # print(mask)
-                                        # print(damp)
-                                        # print(losses_for_backward[sid])
-                                        # print(lambda_()[sid-1])
-                                        closs_for_theta = lambda_.get_loss(sid - 1, damp * mask, (cur_epsilon - losses_for_backward[sid]))
-                                        # closs_for_lambda = lambda_.get_loss(sid - 1, damp, cur_epsilon - losses_for_backward[sid])
-                                        # print(closs_for_theta, closs_for_lambda)        
-                                        # print(closs_for_theta)
-                                        total_loss = total_loss - closs_for_theta
-                                        # total_loss_for_lambda = total_loss_for_lambda - closs_for_lambda
-                                        cur_epsilons.append(cur_epsilon)                                    
+                                    if len(losses_for_backward) > 1: #the secondary losses or constraints, all handled at once as batch_size x constraints tensors
+                                        step_epsilons = epsilon_at(epsilon_schedule, step)
+                                        cur_epsilons = step_epsilons.tolist()
+                                        slack = step_epsilons - torch.stack(losses_for_backward[1:], dim=-1)
+                                        damp = args.dampness * slack.detach()
+                                        mask = lambda_.get_mask(damp)
+                                        closs_for_theta = lambda_.get_loss(damp * mask, slack)
+                                        total_loss = total_loss - closs_for_theta.sum(dim=-1)
                                 
                                 total_batchloss = total_loss.sum()
                                 # total_batchloss.backward(retain_graph=True, scaler=scaler)
                                 
                             
-                            optimizer.backward(total_batchloss, retain_graph=True, scaler=scaler)
+                            memory.sample()
+                            with timers("backward"):
+                                optimizer.backward(total_batchloss, retain_graph=True, scaler=scaler)
                             # outputs.printparams()
                             # if args.debug:
                             #     total_norm = 0
@@ -572,12 +609,11 @@ def main(args):
                             #         param_norm = p.grad.data.norm(2, -1).sum(dim=0)
                             #         print("for theta", param_norm)
 
-                            optimizer.step(scaler=scaler)
+                            with timers("optimizer_step"):
+                                optimizer.step(scaler=scaler)
                             if len(losses) > 1 and not args.linear_scale:
-                                # total_batchloss_for_lambda = total_loss_for_lambda.sum()
-                                # optimizer_lambda.backward(total_batchloss_for_lambda, retain_graph=True, scaler=scaler)
-                                optimizer_lambda.step()
-                                lambda_.make_positive()
+                                with timers("lambda_step"):
+                                    lambda_.step(-slack.detach().sum(dim=0))
                                 # if args.debug:
                                 #     total_norm = 0
                                 #     gi=0
@@ -605,44 +641,45 @@ def main(args):
                                 target_sents = get_sent(torch.cat([target_prefix, pred_tokens], dim=1), primary_tokenizer)
                                 print(target_sents)
                             
-                            cur_losses = []
-                            for b in range(batch_size):
-                                cur_loss = 0.0
-                                for beta, lossval in zip(betas, losses_for_backward):
-                                    cur_loss = cur_loss + beta * lossval[b].item()     
-                                cur_losses.append(cur_loss)
+                            with timers("best_tracking"):
+                                cur_losses = []
+                                for b in range(batch_size):
+                                    cur_loss = 0.0
+                                    for beta, lossval in zip(betas, losses_for_backward):
+                                        cur_loss = cur_loss + beta * lossval[b].item()     
+                                    cur_losses.append(cur_loss)
                                 
-                                constrained = []
-                                allsat = True
-                                for i in range(1, len(losses)):
-                                    if losses_for_backward[i] <= min_epsilons[i - 1]:
-                                        constrained.append("sat")
-                                    else:
-                                        constrained.append("vio")
-                                        allsat=False
+                                    constrained = []
+                                    allsat = True
+                                    for i in range(1, len(losses)):
+                                        if losses_for_backward[i] <= min_epsilons[i - 1]:
+                                            constrained.append("sat")
+                                        else:
+                                            constrained.append("vio")
+                                            allsat=False
                                 
-                                if args.show_all_outputs and len(losses) > 1 and allsat:
-                                    best_prediction_set[b].add(target_sents[b])
+                                    if args.show_all_outputs and len(losses) > 1 and allsat:
+                                        best_prediction_set[b].add(target_sents[b])
                                     
-                                constrained = ",".join(constrained)
-
-                                modify_condition =\
-                                    best_loss[b] is None or\
-                                    (args.selection_criterion == "primary_allsat" and not best_allsat[b] and allsat) or\
-                                    (args.selection_criterion == "primary_allsat" and best_allsat[b] and allsat and best_loss[b] > cur_loss) or\
-                                    (args.selection_criterion == "weighted_sum" and best_loss[b] > cur_loss)
-
-                                if step > 0 and modify_condition:
-                                    print(f"modify condition @{step}")
-                                    best_loss[b] = cur_loss
-                                    best_allsat[b] = allsat
-                                    for i in range(len(losses)):
-                                        best_losses[i][b] = losses_for_backward[i][b].item()
+                                    constrained = ",".join(constrained)
+
+                                    modify_condition =\
+                                        best_loss[b] is None or\
+                                        (args.selection_criterion == "primary_allsat" and not best_allsat[b] and allsat) or\
+                                        (args.selection_criterion == "primary_allsat" and best_allsat[b] and allsat and best_loss[b] > cur_loss) or\
+                                        (args.selection_criterion == "weighted_sum" and best_loss[b] > cur_loss)
+
+                                    if step > 0 and modify_condition:
+                                        print(f"modify condition @{step}")
+                                        best_loss[b] = cur_loss
+                                        best_allsat[b] = allsat
+                                        for i in range(len(losses)):
+                                            best_losses[i][b] = losses_for_backward[i][b].item()
                                     
-                                    best_pred_tokens[b] = pred_tokens[b]
-                                    best_index[b] = step
-                                    best_pred_probs[b] = (pred_probs[b].cpu(), logging_outputs[0]["lm_logprobs"][b])
-                                    best_constrained = constrained
+                                        best_pred_tokens[b] = pred_tokens[b]
+                                        best_index[b] = step
+                                        best_pred_probs[b] = (pred_probs[b].cpu(), logging_outputs[0]["lm_logprobs"][b])
+                                        best_constrained = constrained
                                     
                             if step > 0 and step % args.log_interval == 0:
                                 if len(losses) > 1:
@@ -669,12 +706,16 @@ def main(args):
                                     log = log + "]"
                                     print(log)
                             
+                            keep_going = budget.keep_going(step, losses_for_backward, min_epsilons)
                             del losses_for_backward
+                            if not keep_going:
+                                break
 
                         except KeyboardInterrupt:
                             print("skipping remaining optimizing steps and showing the best option so far")
                             broken=True
                             break
+                    budget.end_run()
 
                     predictions = []
                     prediction_idss = []
@@ -748,12 +789,15 @@ def main(args):
 
                     all_stepcounts += best_index
 
+                    memory.end_run(outputs, optimizer)
                     optimizer.zero_grad(set_to_none=True)
+                    if args.warm_start != "none":
+                        prev_outputs = outputs
+                        if len(losses) > 1:
+                            prev_lambda = lambda_
                     del outputs
                     del optimizer
                     if len(losses) > 1:
-                        optimizer_lambda.zero_grad()
-                        del optimizer_lambda
                         del lambda_
                     for modelname in loss2modelname.values():
                         name2model[modelname].zero_grad(set_to_none=True) 
@@ -787,6 +831,9 @@ def main(args):
                         
                         outallsatf.flush()
 
+            timers.end_example(example=c)
+            budget.end_example(example=c)
+
             del source_batch
             del target_batch
             del additional_batch
@@ -803,6 +850,59 @@ def main(args):
         outallsatf.close()
     print("average numbers of steps to converge =", np.mean(all_stepcounts))
 
+    if args.timing_report is not None:
+        print(timers)
+        timers.write(args.timing_report)
+        print(f"dumped the step timings to {args.timing_report}")
+
+    if budget.enabled:
+        print(budget)
+        if args.outfile is not None:
+            budget.write(args.outfile + ".budget.json")
+            print(f"dumped the budget split to {args.outfile}.budget.json")
+
+    if args.memory_report:
+        print(memory)
+        if args.outfile is not None:
+            memory.write(args.outfile + ".memory.json")
+            print(f"dumped the memory report to {args.outfile}.memory.json")
+
+def forward_step(outputs, embed_luts, lossfns, lossabbr, source_batch, target_prefix, additional_batch, embed_scales, label_ids, timers=None, memory=None):
+    """
+    One forward pass of the optimization: projects the target onto the embedding tables of every model and computes all the losses.
+    This is the part of the step which is captured by --compile-step.
+    """
+    if timers is None:
+        timers = null_timer
+    if memory is None:
+        memory = null_memory
+
+    losses_for_backward = []
+    logging_outputs = []
+
+    with timers("forward"):
+        pred_embeds, pred_tokens, pred_probs = outputs.forward_multiple(embed_luts)
+
+    original_preds = None
+    if len(pred_embeds) > 1:
+        original_preds = pred_embeds[1]
+
+    for lossid, lossfn in enumerate(lossfns):
+        with timers(f"loss/{lossabbr[lossid]}"), memory(lossabbr[lossid]):
+            lossvalue, logging_output =\
+                lossfn.compute_loss(
+                    [source_batch, target_prefix], 
+                    [pred_tokens, pred_embeds[0][lossid], pred_probs], 
+                    additional_batch=additional_batch, 
+                    embed_scale=embed_scales[lossid], 
+                    label_id=label_ids[lossid],
+                    original_preds=original_preds
+                )
+        losses_for_backward.append(lossvalue.float()) #losses can come out in half precision under autocast, selection and the lagrangian are computed in fp32
+        logging_outputs.append(logging_output)
+    
+    return pred_embeds, pred_tokens, pred_probs, losses_for_backward, logging_outputs
+
 def clean_output(tokens, eos_token_id, return_tensors=False):
     # print(tokens)
     new_tokens = []
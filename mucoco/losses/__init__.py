@@ -42,19 +42,36 @@ def register_loss(name):
     return register_loss_cls
 
 def build_loss(lossname, model, tokenizer, args):
+    if lossname not in LOSS_REGISTRY:
+        import_loss(lossname)
     if lossname in LOSS_REGISTRY:
         return LOSS_REGISTRY[lossname](model, tokenizer, args)
     else:
         raise ValueError(f"This loss module does not exist: {lossname}")
 
-# automatically import any Python files in the losses/ directory
+def import_loss(lossname):
+    """
+    Import the module defining ``lossname`` so that it registers itself. Loss
+    modules are looked up by file name first; if a module registers its loss
+    under a different name, every known loss module is imported as a fallback.
+    """
+    if lossname in LOSS_MODULES:
+        importlib.import_module(LOSS_MODULES[lossname])
+    if lossname not in LOSS_REGISTRY:
+        for module in LOSS_MODULES.values():
+            importlib.import_module(module)
+
+# record (but don't import) the Python files in the losses/ directory. Importing 
+# a loss pulls in its dependencies (e.g. POT for wmd), so this happens lazily in build_loss
+LOSS_MODULES = {}
 losses_dir = os.path.dirname(__file__)
 for file in os.listdir(losses_dir):
     path = os.path.join(losses_dir, file)
     if (
         not file.startswith("_")
         and not file.startswith(".")
+        and file != "base_loss.py"
         and (file.endswith(".py") or os.path.isdir(path))
     ):
         loss_name = file[: file.find(".py")] if file.endswith(".py") else file
-        module = importlib.import_module("mucoco.losses." + loss_name)
+        LOSS_MODULES[loss_name] = "mucoco.losses." + loss_name
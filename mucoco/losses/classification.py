@@ -33,8 +33,8 @@ class ClassificationLoss(BaseLoss):
         pred_tokens, pred_embeds, pred_probs = preds
         batch_size = pred_embeds.size(0)
 
-        bos = torch.empty((source.size(0), 1)).long().to(self.device).fill_(self.bos_token_id)
-        eos = torch.empty((source.size(0), 1)).long().to(self.device).fill_(self.eos_token_id)
+        bos = torch.full((source.size(0), 1), self.bos_token_id, dtype=torch.long, device=self.device)
+        eos = torch.full((source.size(0), 1), self.eos_token_id, dtype=torch.long, device=self.device)
 
         #input_tokens = torch.cat([bos, prefix, pred_tokens, eos], dim=1)
 
@@ -47,8 +47,6 @@ class ClassificationLoss(BaseLoss):
         label_id = kwargs.get("label_id", 1)
         loss = -lm_logprobs[:, label_id] #label_id = 1
 
-        label_prediction = lm_logprobs.argmax(dim=-1).item()
-
         logging_output = {
             "loss": loss.data.cpu(),
             "max_length": prefix.size(1) + pred_tokens.size(1),
@@ -33,16 +33,16 @@ class GPT2ConditionalLoss(BaseLoss):
         batch_size = source.size(0)
         max_prefix_length = getattr(self.args, 'max_prefix_length', source.size(1) + 1)
         pad_length = max(0, max_prefix_length - source.size(1))
-        bos = torch.empty((batch_size, 1)).long().to(self.device).fill_(self.bos_token_id)
-        pad = torch.empty((batch_size, pad_length)).long().to(self.device).fill_(self.pad_token_id)
-        eos = torch.empty((batch_size, 1)).long().to(self.device).fill_(self.eos_token_id) 
+        bos = torch.full((batch_size, 1), self.bos_token_id, dtype=torch.long, device=self.device)
+        pad = torch.full((batch_size, pad_length), self.pad_token_id, dtype=torch.long, device=self.device)
+        eos = torch.full((batch_size, 1), self.eos_token_id, dtype=torch.long, device=self.device) 
         # input_tokens = torch.cat([pad, source, bos, prefix, pred_tokens, eos], dim=1)
 
         embed_lut = self.model.get_input_embeddings()
         input_embeds = torch.cat([embed_lut(pad), embed_lut(source), embed_lut(bos), embed_lut(prefix), pred_embeds, embed_lut(eos)], dim=1)
 
-        source_segment_id = torch.empty((batch_size, pad_length + source.size(1))).long().to(self.device).fill_(self.tokenizer.additional_special_tokens_ids[1])
-        target_segment_id = torch.empty((batch_size, prefix.size(1) + pred_tokens.size(1) + 2)).long().to(self.device).fill_(self.tokenizer.additional_special_tokens_ids[2])
+        source_segment_id = torch.full((batch_size, pad_length + source.size(1)), self.tokenizer.additional_special_tokens_ids[1], dtype=torch.long, device=self.device)
+        target_segment_id = torch.full((batch_size, prefix.size(1) + pred_tokens.size(1) + 2), self.tokenizer.additional_special_tokens_ids[2], dtype=torch.long, device=self.device)
         segment = torch.cat([source_segment_id, target_segment_id], dim=1)
 
         losstype = getattr(self.args, "loss_type", "xentropy")
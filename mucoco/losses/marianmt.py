@@ -16,6 +16,7 @@ class MarianMTLoss(BaseLoss):
         self.device = model.device
 
         self.pad_token_id = self.tokenizer.pad_token_id
+        self.eos_token_id = self.tokenizer.eos_token_id
     
     def compute_loss(self, batch, preds, **kwargs):
         '''
@@ -27,7 +28,8 @@ class MarianMTLoss(BaseLoss):
         pred_tokens, pred_embeds, pred_probs = preds
         pred_probs = pred_probs[0]
 
-        bos = torch.empty((source.size(0), 1)).long().to(self.device).fill_(self.pad_token_id)
+        batch_size = source.size(0)
+        bos = torch.full((source.size(0), 1), self.pad_token_id, dtype=torch.long, device=self.device)
         target_input_tokens = torch.cat([bos, prefix, pred_tokens], dim=1)
 
         embed_lut = self.model.get_decoder().get_input_embeddings()
@@ -44,7 +46,7 @@ class MarianMTLoss(BaseLoss):
         
         xentropy_pred = (-lm_logprobs[:, prefix.size(1): -1, :] * pred_probs).sum(dim=-1) 
         xentropy_pred = xentropy_pred.sum(dim=-1)
-        xentropy_pred = xentropy_pred - lm_logprobs[:, -1, tokenizer.eos_token_id]
+        xentropy_pred = xentropy_pred - lm_logprobs[:, -1, self.eos_token_id]
 
         _, mm = lm_logprobs.max(dim=-1)
 
@@ -31,8 +31,8 @@ class USimLoss(BaseLoss):
         gold_features = mean_pooling(self.model(input_ids=source), attention_mask=torch.ones(source.size(0), source.size(1)).to(self.device))
         gold_features = gold_features.detach()  # don't need to pass gradients through this
 
-        bos = torch.empty((source.size(0), 1)).long().to(source.device).fill_(self.bos_token_id)
-        eos = torch.empty((source.size(0), 1)).long().to(source.device).fill_(self.eos_token_id)
+        bos = torch.full((source.size(0), 1), self.bos_token_id, dtype=torch.long, device=source.device)
+        eos = torch.full((source.size(0), 1), self.eos_token_id, dtype=torch.long, device=source.device)
         # target = torch.cat([bos, target_prefix, pred_tokens, eos], dim=1)
         #probably useless, delete if true
 
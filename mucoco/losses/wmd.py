@@ -15,6 +15,8 @@ import numpy as np
 class WMD(BaseLoss):
     def __init__(self, model, tokenizer, args):
         super().__init__()
+        if ot is None:
+            raise ImportError("the wmd loss requires POT, install it with `pip install pot`")
 
         self.model = model 
         self.tokenizer = tokenizer 
@@ -32,8 +34,8 @@ class WMD(BaseLoss):
 
         batch_size = source.size(0)
 
-        bos = torch.empty((batch_size, 1)).long().to(self.device).fill_(self.bos_token_id)
-        eos = torch.empty((batch_size, 1)).long().to(self.device).fill_(self.eos_token_id) 
+        bos = torch.full((batch_size, 1), self.bos_token_id, dtype=torch.long, device=self.device)
+        eos = torch.full((batch_size, 1), self.eos_token_id, dtype=torch.long, device=self.device) 
 
         # target = torch.cat([bos, target_prefix, pred_tokens, eos], dim=1)
 
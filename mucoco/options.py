@@ -53,6 +53,7 @@ def get_parser():
         type=str,
         choices=["zeros", "random", "source", "target"],
     )
+    parser.add_argument("--warm-start", default="none", type=str, choices=["none", "append", "insert"], help="initialize every candidate length (and the lagrange multipliers) from the solution of the previous length, the new position is appended at the end or inserted before the last one")
     parser.add_argument(
         "--sampling-strategy",
         default="greedy",
@@ -144,6 +145,10 @@ def get_parser():
 
     parser.add_argument("--optim", default="sgd", help="which optimizer")
     parser.add_argument("--optim-steps", default=10, type=int)
+    parser.add_argument("--total-steps", default=None, type=int, help="total number of optimization steps for the whole dataset, split between the examples depending on their progress (instead of --optim-steps for each)")
+    parser.add_argument("--time-budget", default=None, type=float, help="total wall clock time (in seconds) for the whole dataset, split between the examples depending on their progress")
+    parser.add_argument("--budget-window", default=10, type=int, help="with --total-steps/--time-budget, check the progress towards the epsilons every this many steps and extend or stop the optimization")
+    parser.add_argument("--budget-min-progress", default=0.01, type=float, help="with --total-steps/--time-budget, minimum relative decrease of the constraint violation over a window to keep optimizing")
     parser.add_argument("--warmup-steps", default=1, type=int)
     parser.add_argument("--warmup-init-lr", default=None, type=float)
     parser.add_argument("--warmup-end-lr", default=None, type=float)
@@ -155,7 +160,11 @@ def get_parser():
     parser.add_argument("--decay-steps", default=1, type=int)
 
     parser.add_argument("--batch-size", default=1, type=int)
-    parser.add_argument("--model_dtype", default="fp32", help="fp32 or fp16")
+    parser.add_argument("--model_dtype", default="fp32", choices=["fp32", "fp16", "bf16"], help="fp32, fp16 or bf16. fp16/bf16 run the forward passes under autocast (bf16 on cpu) while the optimized target stays in fp32")
+    parser.add_argument("--compile-step", default="none", type=str, choices=["none", "inductor", "aot_eager", "eager"], help="capture the target forward and the loss computation with torch.compile using this backend. Graphs are cached per (batch size, length)")
+    parser.add_argument("--timing-report", default=None, type=str, help="write per-phase timings of the optimization loop (per example and per run) to this json file")
+    parser.add_argument("--memory-report", action="store_true", help="track the memory usage per example and per length and write it next to the outputs (outfile.memory.json)")
+    parser.add_argument("--memory-warning-fraction", default=0.9, type=float, help="warn when the peak memory usage goes above this fraction of the available (GPU or system) memory")
     parser.add_argument("--fp16_source", default="pytorch", help="apex or pytorch", choices=["apex", "pytorch"])
     parser.add_argument(
         "--decay-method", default=None, help="how to decay the learning rate"
@@ -220,3 +229,56 @@ def get_parser():
     )
 
     return parser
+
+
+def get_benchmark_parser():
+    # the benchmark shares the target/optimizer options with decoding (e.g. --optim, --lr, --st, --optim-steps)
+    parser = get_parser()
+    group = parser.add_argument_group("benchmark")
+    group.add_argument("--target-types", default="probs:simplex:embeds", type=str, help="target types to benchmark, separated by :")
+    group.add_argument("--benchmark-losses", default=None, type=str, help="losses to benchmark, separated by : (default: all the losses with a tiny model)")
+    group.add_argument("--batch-sizes", default="1:4", type=str, help="batch sizes to benchmark, separated by :")
+    group.add_argument("--lengths", default="10:20", type=str, help="target lengths to benchmark, separated by :")
+    group.add_argument("--vocab-sizes", default="1000:10000", type=str, help="vocabulary sizes of the tiny models, separated by :")
+    group.add_argument("--source-length", default=20, type=int, help="length of the random source sentences")
+    group.add_argument("--benchmark-warmup-steps", default=3, type=int, help="untimed steps before timing every configuration")
+    group.add_argument("--hidden-size", default=64, type=int, help="hidden size of the tiny models")
+    group.add_argument("--num-layers", default=2, type=int, help="number of layers of the tiny models")
+    group.add_argument("--num-heads", default=2, type=int, help="number of attention heads of the tiny models")
+    group.add_argument("--max-positions", default=128, type=int, help="max positions of the tiny models")
+    group.add_argument("--baseline", default=None, type=str, help="results (jsonl) of an earlier run to compare against")
+    return parser
+
+
+def get_evaluation_parser():
+    # all_evaluation_metrics.py reads --data, --model, --outfile, --batch-size, --evaluation_metrics and --match_with from the decoding options
+    parser = get_parser()
+    parser.add_argument("--pred")
+    group = parser.add_argument_group("evaluation")
+    group.add_argument("--comparison", default=None, action="append", help="named set of references to compare the hypotheses (first file of --data) with, e.g. --comparison source=informal --comparison reference=formal.ref0,formal.ref1. Can be repeated, all the sets are scored in one pass (default: the rest of --data, named after --match_with)")
+    group.add_argument("--systems", default=None, help="comma separated hypotheses files (e.g. decodes with different settings) scored against the same references in one run, sharing the models, the reference features and the batches. --data then only lists the references, --outfile (and --score-store) should contain {system}")
+    group.add_argument("--systems-table", default=None, help="with --systems, tab separated file comparing the average scores of the systems")
+    group.add_argument("--offline", action="store_true", help="load the huggingface models (content model, ppl model) from the local cache only, without network access")
+    group.add_argument("--emd-solver", default="exact", choices=["exact", "sinkhorn"], help="how wmd and moverscore compute the earth mover's distance: exact (POT, on cpu) or batched entropic sinkhorn iterations on the device of the model")
+    group.add_argument("--emd-workers", default=0, type=int, help="size of the process pool solving the exact EMD problems of a batch (0: solve them in the main process)")
+    group.add_argument("--sinkhorn-reg", default=0.05, type=float, help="entropic regularization of the sinkhorn solver (smaller is closer to the exact EMD but needs more iterations)")
+    group.add_argument("--sinkhorn-tol", default=1e-4, type=float, help="stop the sinkhorn iterations when the marginals are off by less than this")
+    group.add_argument("--sinkhorn-max-iter", default=1000, type=int, help="maximum number of sinkhorn iterations")
+    group.add_argument("--metric-workers", default=1, type=int, help="number of metric stages (transfer, fluency, bertscore, content (wmd, moverscore, cls_sim, sts_sim), wieting_sim) running concurrently in threads")
+    group.add_argument("--stage-batch-sizes", default=None, type=str, help="batch size of each stage, e.g. content=64,transfer=32 (default: --batch-size)")
+    group.add_argument("--wieting-model", default=None, type=str, help="checkpoint of the wieting_sim model (default: DEFAULT_MODEL of evaluation/similarity/test_sim.py)")
+    group.add_argument("--wieting-sp-model", default=None, type=str, help="sentencepiece model of the wieting_sim model (default: DEFAULT_SP_MODEL of evaluation/similarity/test_sim.py)")
+    group.add_argument("--wieting-batch-size", default=1024, type=int, help="number of sentence pairs wieting_sim scores at once")
+    group.add_argument("--wieting-workers", default=0, type=int, help="size of the process pool tokenizing the sentences for wieting_sim (0: tokenize in the main process)")
+    group.add_argument("--follow", action="store_true", help="score the hypotheses (first file of --data) while they are being written, e.g. by decode.py, until the done marker exists")
+    group.add_argument("--follow-block", default=100, type=int, help="with --follow, score the new hypotheses once there are at least this many of them")
+    group.add_argument("--follow-interval", default=5.0, type=float, help="with --follow, seconds between two checks for new hypotheses")
+    group.add_argument("--follow-timeout", default=3600.0, type=float, help="with --follow, give up when the hypotheses file did not grow for this many seconds and there is no done marker (0: wait forever)")
+    group.add_argument("--done-marker", default=None, type=str, help="with --follow, file signaling that all the hypotheses are written (default: <hypotheses>.done, created by decode.py)")
+    group.add_argument("--score-store", default=None, type=str, help="columnar file (.npz, or .parquet with pyarrow) collecting the per-sentence scores of every metric and comparison set (default: <hypotheses>.scores.npz)")
+    group.add_argument("--ppl-model", default="gpt2-large", type=str, help="causal lm scoring the fluency of the hypotheses for the ppl metric")
+    group.add_argument("--ppl-max-length", default=None, type=int, help="longest window the ppl model scores at once (default: its max positions)")
+    group.add_argument("--ppl-stride", default=None, type=int, help="how far the ppl window slides over longer sentences, smaller than --ppl-max-length (default: half the window)")
+    group.add_argument("--classifier-max-tokens", default=8192, type=int, help="the transfer and fluency classifiers run in micro batches of at most this many tokens (including padding)")
+    group.add_argument("--feature-cache", default=None, type=str, help="directory of a disk cache of the content model features of the references (cls_sim, sts_sim, moverscore), so that they are only encoded by the first evaluation")
+    return parser
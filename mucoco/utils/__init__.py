@@ -1,4 +1,8 @@
 from mucoco.utils.lambdas import Lambda
 from mucoco.utils.targets import TargetProbability, TargetSimplex, TargetEmbeddings
 from mucoco.utils.optim import Optimizer
-from mucoco.utils.misc import get_epsilon
\ No newline at end of file
+from mucoco.utils.misc import get_epsilon
+from mucoco.utils.compile import CompiledStep
+from mucoco.utils.timers import StepTimers
+from mucoco.utils.memory import MemoryTracker
+from mucoco.utils.budget import BudgetAllocator
\ No newline at end of file
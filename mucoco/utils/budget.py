@@ -0,0 +1,177 @@
+import json
+import time
+
+
+class BudgetAllocator(object):
+    """
+    Splits a dataset-level compute budget (a total number of optimization steps or a wall clock budget in seconds)
+    between the examples, instead of spending a fixed --optim-steps on every one of them.
+
+    Every example gets a base allocation (its fair share of the budget) which is split between its candidate lengths.
+    The optimization of a length is checked every ``window`` steps and when its allocation runs out: if the constraint violation (how far the constraints
+    are above their epsilons, or the primary loss when there are no constraints) went down by at least ``min_progress``
+    (relative) during the window, the length gets ``window`` extra steps from the pool, otherwise the remaining steps
+    are withdrawn and returned to the pool. Examples skipped because the beam search output already satisfies the
+    constraints don't use their share either. With a wall clock budget, the budget is converted to steps using the
+    average time of the steps so far.
+
+    When no budget is given, every length runs for exactly ``default_steps`` steps (--optim-steps).
+
+    Args:
+        num_examples: number of examples (batches) the budget is split between
+        default_steps: steps per length when there's no budget, and the base allocation before any timing is available
+        total_steps: total number of optimization steps for the whole dataset
+        time_budget: total wall clock time (in seconds) for the whole dataset
+        window: number of steps between two progress checks (and size of an extension)
+        min_progress: minimum relative decrease of the violation during a window to keep optimizing
+    """
+
+    def __init__(self, num_examples, default_steps, total_steps=None, time_budget=None, window=10, min_progress=0.01):
+        if total_steps is not None and time_budget is not None:
+            raise ValueError("only one of --total-steps and --time-budget can be set")
+
+        self.enabled = total_steps is not None or time_budget is not None
+        self.num_examples = max(num_examples, 1)
+        self.default_steps = default_steps
+        self.total_steps = total_steps
+        self.time_budget = time_budget
+        self.window = max(window, 1)
+        self.min_progress = min_progress
+
+        self.start_time = time.perf_counter()
+        self.steps_done = 0
+        self.step_time = 0.0
+        self.examples_done = 0
+        self.examples = []
+        self.example = None
+        self.run = None
+
+    def _avg_step_time(self):
+        return self.step_time / self.steps_done if self.steps_done > 0 else None
+
+    def _remaining_steps(self):
+        if self.total_steps is not None:
+            return self.total_steps - self.steps_done
+        if self._avg_step_time() is None:
+            return self.default_steps * (self.num_examples - self.examples_done)
+        return int((self.time_budget - (time.perf_counter() - self.start_time)) / self._avg_step_time())
+
+    def _share(self):
+        """base allocation of an example"""
+        if self.total_steps is not None:
+            return self.total_steps // self.num_examples
+        if self._avg_step_time() is None:
+            return self.default_steps
+        return int(self.time_budget / self.num_examples / self._avg_step_time())
+
+    def _later_examples(self):
+        return max(self.num_examples - self.examples_done - 1, 0)
+
+    def _pool(self):
+        """steps of the budget which are not reserved for the current run, the other lengths of the current example or the base allocation of the later examples"""
+        reserved = self.run["allowed"] - self.run["steps"] + self.example["reserved"] + self._share() * self._later_examples()
+        return self._remaining_steps() - reserved
+
+    def start_example(self, num_runs):
+        """num_runs: number of candidate lengths the example will be optimized for"""
+        if self.enabled:
+            base = max(min(self._share(), self._remaining_steps() - self._share() * self._later_examples()), 0)
+        else:
+            base = self.default_steps * num_runs
+        self.example = {"base": base, "steps": 0, "extended": 0, "withdrawn": 0, "runs": [], "reserved": base, "num_runs": max(num_runs, 1)}
+
+    def start_run(self, **info):
+        if self.example is None:
+            self.start_example(1)
+        example = self.example
+        if self.enabled:
+            # the base allocation of the example is split evenly between its lengths
+            allowed = max(example["reserved"] // max(example["num_runs"] - len(example["runs"]), 1), 0)
+        else:
+            allowed = self.default_steps
+        example["reserved"] -= allowed
+        self.run = dict(info)
+        self.run.update({"allowed": allowed, "steps": 0, "extended": 0, "withdrawn": 0, "violation": None})
+        self.last_time = time.perf_counter()
+
+    def has_steps(self):
+        """whether the current run can take another step, checked before the first one (--optim-steps 0 or an exhausted budget)"""
+        return self.run["steps"] < self.run["allowed"]
+
+    def keep_going(self, step, losses, epsilons):
+        """
+        called at the end of every step of a run with the losses of the step, returns whether to run another step
+        losses: primary loss followed by the constraints, epsilons: the thresholds of the constraints
+        """
+        run = self.run
+        run["steps"] = step + 1
+        if not self.enabled:
+            return run["steps"] < run["allowed"]
+
+        now = time.perf_counter()
+        self.step_time += now - self.last_time
+        self.last_time = now
+        self.steps_done += 1
+
+        # also checked when the allocation runs out, which is not always at the end of a window
+        if run["steps"] == 1 or run["steps"] % self.window == 0 or run["steps"] >= run["allowed"]:
+            violation = sum((losses[i] - epsilons[i-1]).clamp(min=0).sum().item() for i in range(1, len(losses)))
+            if len(losses) == 1:
+                violation = losses[0].sum().item()
+
+            if run["violation"] is not None and violation > 0:
+                progress = (run["violation"] - violation) / max(abs(run["violation"]), 1e-9)
+                if progress < self.min_progress:
+                    # stalled, give the rest of the allocation back to the pool
+                    run["withdrawn"] = max(run["allowed"] - run["steps"], 0)
+                    run["allowed"] = run["steps"]
+                elif run["steps"] >= run["allowed"] and self._pool() >= self.window:
+                    run["extended"] += self.window
+                    run["allowed"] += self.window
+            run["violation"] = violation
+
+        return run["steps"] < run["allowed"]
+
+    def end_run(self):
+        run = self.run
+        example = self.example
+        example["steps"] += run["steps"]
+        example["extended"] += run["extended"]
+        example["withdrawn"] += run["withdrawn"]
+        example["runs"].append({key: value for key, value in run.items() if key != "violation"})
+        self.run = None
+
+    def end_example(self, **info):
+        """closes the current example, info (e.g. the example id) is stored alongside it in the report"""
+        if self.example is None: # skipped, e.g. the beam search output already satisfies the constraints
+            self.example = {"base": 0, "steps": 0, "extended": 0, "withdrawn": 0, "runs": [], "skipped": True}
+        example = {key: value for key, value in self.example.items() if key not in ["reserved", "num_runs"]}
+        example.update(info)
+        self.examples.append(example)
+        self.examples_done += 1
+        self.example = None
+
+    def summary(self):
+        summary = {
+            "total_steps": self.total_steps,
+            "time_budget": self.time_budget,
+            "steps": sum(example["steps"] for example in self.examples),
+            "time": time.perf_counter() - self.start_time,
+            "extended": sum(example["extended"] for example in self.examples),
+            "withdrawn": sum(example["withdrawn"] for example in self.examples),
+            "skipped": sum(1 for example in self.examples if example.get("skipped", False)),
+            "examples": self.examples,
+        }
+        return summary
+
+    def write(self, path):
+        with open(path, "w") as fout:
+            json.dump(self.summary(), fout, indent=2)
+
+    def __str__(self):
+        summary = self.summary()
+        budget = f"{self.total_steps} steps" if self.total_steps is not None else f"{self.time_budget}s"
+        lines = [f"budget {budget}: used {summary['steps']} steps in {summary['time']:.1f}s, {summary['extended']} steps given as extensions, {summary['withdrawn']} withdrawn, {summary['skipped']} examples skipped"]
+        for i, example in enumerate(self.examples):
+            lines.append(f"example {example.get('example', i)}: base {example['base']}, used {example['steps']} (+{example['extended']}, -{example['withdrawn']}) over {len(example['runs'])} lengths")
+        return "\n".join(lines)
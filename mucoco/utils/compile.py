@@ -0,0 +1,54 @@
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class CompiledStep(object):
+    """
+    Wraps a step function (target forward + constraint losses) with ``torch.compile``.
+
+    Graphs are specialized on the shape of the target (``dynamic=False``) so every
+    (batch size, length) bucket gets its own compiled version, which is cached and
+    reused by all the examples falling into the same bucket.
+
+    Args:
+        fn: the step function to compile
+        backend: the torch.compile backend (e.g. "inductor", "aot_eager")
+        max_buckets: how many shape buckets can be cached before falling back to eager mode
+    """
+
+    def __init__(self, fn, backend="inductor", max_buckets=64):
+        if not hasattr(torch, "compile"):
+            raise ValueError("--compile-step requires pytorch >= 2.0")
+
+        import torch._dynamo as dynamo
+
+        # every shape bucket is a separate cache entry for the same code object
+        dynamo.config.cache_size_limit = max(dynamo.config.cache_size_limit, max_buckets)
+        # decode.py calls backward with retain_graph=True which is incompatible with donated buffers
+        import torch._functorch.config as functorch_config
+        if hasattr(functorch_config, "donated_buffer"):
+            functorch_config.donated_buffer = False
+
+        self.fn = fn
+        self.backend = backend
+        self.compiled = {}
+
+    def __call__(self, bucket, *args, dynamic_inputs=(), **kwargs):
+        """
+        bucket: the (batch size, length) key of the compiled graph to use
+        dynamic_inputs: tensors whose length (dim 1) varies from example to example within a bucket (e.g. the source sentence),
+            they are marked dynamic so that they don't trigger a recompilation for every example
+        """
+        import torch._dynamo as dynamo
+
+        for tensor in dynamic_inputs:
+            if tensor.dim() > 1:
+                dynamo.maybe_mark_dynamic(tensor, 1)
+
+        if bucket not in self.compiled:
+            logger.info(f"compiling the step function for shape bucket {bucket} with backend {self.backend}")
+            self.compiled[bucket] = torch.compile(self.fn, backend=self.backend, dynamic=False)
+        return self.compiled[bucket](*args, **kwargs)
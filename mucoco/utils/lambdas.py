@@ -1,20 +1,34 @@
 import torch
 
 class Lambda(torch.nn.Module): #multipliers for the constraints
-    def __init__(self, count=1):
+    def __init__(self, count=1, lr=1.0, lr_decay_fn=None):
         super(Lambda, self).__init__()
-        self.lambda_ = torch.nn.Parameter(torch.Tensor([0. for _ in range(count)]))
+        # the multipliers are updated in closed form (see step), they don't need gradients
+        self.lambda_ = torch.nn.Parameter(torch.zeros(count), requires_grad=False)
+        self.lr = lr
+        self.lr_decay_fn = lr_decay_fn
+        self._step = 1
 
     def forward(self):
         return self.lambda_
 
-    def get_mask(self, i, damp):
+    def get_mask(self, damp):
         # if constraint is satified and lambda < damp, then don't use lambdas to update thetas
-        return 1 - damp.ge(0.).float() * self.lambda_[i].data.le(damp).float()
+        # damp: batch_size x count, one column per constraint
+        return 1 - damp.ge(0.).float() * self.lambda_.le(damp).float()
+
+    def get_loss(self, damp, loss):
+        return (self.lambda_ - damp) * loss
+
+    def step(self, violation):
+        """
+        projected gradient ascent on the multipliers: lambda = max(0, lambda + lr * violation), where violation (one value per constraint)
+        is the gradient of the lagrangian wrt lambda, i.e. how much the constraints are above their epsilons summed over the batch.
+        lr follows the same decay function as the optimizer of the target.
+        """
+        scale = 1.0 if self.lr_decay_fn is None else self.lr_decay_fn(self._step)
+        self.lambda_.data.add_(violation, alpha=scale * self.lr).clamp_(min=0.)
+        self._step += 1
 
-    def get_loss(self, i, damp, loss):
-        return (self.lambda_[i] - damp) * loss
-    
     def make_positive(self):
-        posmask = self.lambda_.detach() > 0.
-        self.lambda_.data.copy_(self.lambda_.data * posmask.float())
\ No newline at end of file
+        self.lambda_.data.clamp_(min=0.)
\ No newline at end of file
@@ -0,0 +1,194 @@
+import json
+import os
+import resource
+import sys
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+def _rss():
+    """current resident set size of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return _peak_rss()
+
+
+def _peak_rss():
+    """peak resident set size of the process in bytes (ru_maxrss is in bytes on macOS and in kilobytes elsewhere)"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _total_cpu_memory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _storage(tensor):
+    """storage of a tensor, untyped_storage needs torch >= 2.0"""
+    if hasattr(tensor, "untyped_storage"):
+        return tensor.untyped_storage()
+    return tensor.storage()
+
+
+def _storage_bytes(storage):
+    if hasattr(storage, "nbytes"):
+        return storage.nbytes()
+    return storage.size() * storage.element_size()
+
+
+def _tensor_bytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors if torch.is_tensor(t))
+
+
+def _mb(x):
+    return x / 2 ** 20
+
+
+class MemoryTracker(object):
+    """
+    Tracks memory usage of the decoding loop for every (example, length) optimization run: peak and steady-state
+    CPU RSS, CUDA allocator stats when running on GPU, and how much of it is taken by the target parameters,
+    the optimizer state and the activations each loss saves for backward.
+
+    Args:
+        enabled: whether to record anything
+        cuda: also read the CUDA allocator stats
+        model_params: parameters of the loaded models, so that weights saved for backward are not counted as activations
+        warning_fraction: warn when the peak usage goes above this fraction of the available memory
+    """
+
+    def __init__(self, enabled=False, cuda=False, model_params=(), warning_fraction=0.9):
+        self.enabled = enabled
+        self.cuda = cuda
+        self.warning_fraction = warning_fraction
+        self.runs = []
+        self.current = None
+        self.warned = False
+
+        if not enabled:
+            return
+
+        self.model_storages = set(_storage(p).data_ptr() for p in model_params)
+        self.model_bytes = _tensor_bytes(model_params)
+        if cuda:
+            self.capacity = torch.cuda.get_device_properties(torch.cuda.current_device()).total_memory
+        else:
+            self.capacity = _total_cpu_memory()
+
+    def start_run(self, **info):
+        if not self.enabled:
+            return
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats()
+        self.current = dict(info)
+        self.current["activations"] = {}
+        self.current["cpu_rss_peak"] = _rss()
+
+    @contextmanager
+    def activations(self, name):
+        """records the number of bytes saved for backward by the code running inside this context (e.g. a loss)"""
+        if not self.enabled or self.current is None:
+            yield
+            return
+
+        seen = set()
+        saved = [0]
+
+        def pack(tensor):
+            storage = _storage(tensor)
+            ptr = storage.data_ptr()
+            if ptr not in seen and ptr not in self.model_storages:
+                seen.add(ptr)
+                saved[0] += _storage_bytes(storage)
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            yield
+
+        activations = self.current["activations"]
+        activations[name] = max(activations.get(name, 0), saved[0])
+
+    def sample(self):
+        """samples the memory usage, call it where usage peaks (e.g. after the forward pass, before backward)"""
+        if not self.enabled or self.current is None:
+            return
+        self.current["cpu_rss_peak"] = max(self.current["cpu_rss_peak"], _rss())
+        self._check(self.current["cpu_rss_peak"] if not self.cuda else torch.cuda.max_memory_allocated(), self.current)
+
+    def end_run(self, target, optimizer=None):
+        if not self.enabled or self.current is None:
+            return
+
+        run = self.current
+        run["target_params"] = _tensor_bytes(list(target.parameters()))
+        run["optimizer_state"] = 0
+        if optimizer is not None:
+            for state in optimizer._optimizer.state.values():
+                run["optimizer_state"] += _tensor_bytes(state.values())
+        run["cpu_rss"] = _rss()
+        run["cpu_rss_peak"] = max(run["cpu_rss_peak"], run["cpu_rss"])
+        if self.cuda:
+            run["cuda_allocated"] = torch.cuda.memory_allocated()
+            run["cuda_reserved"] = torch.cuda.memory_reserved()
+            run["cuda_peak"] = torch.cuda.max_memory_allocated()
+
+        self.runs.append(run)
+        self.current = None
+        self._check(run["cuda_peak"] if self.cuda else run["cpu_rss_peak"], run)
+
+    def _check(self, peak, run):
+        """warns (once) as soon as the usage gets close to the capacity, before the process actually runs out of memory"""
+        if self.capacity is None or self.warned:
+            return
+        if peak > self.warning_fraction * self.capacity:
+            self.warned = True
+            print(f"WARNING: peak memory usage ({_mb(peak):.0f}MB) at length {run.get('length')} is above {100 * self.warning_fraction:.0f}% of the available memory ({_mb(self.capacity):.0f}MB). "
+                  "Consider reducing --max-allowed-length or --batch-size to avoid running out of memory")
+
+    def summary(self):
+        lengths = {}
+        for run in self.runs:
+            stats = lengths.setdefault(run.get("length"), {})
+            for key in ["cpu_rss_peak", "cuda_peak", "target_params", "optimizer_state"]:
+                if key in run:
+                    stats[key] = max(stats.get(key, 0), run[key])
+            for name, value in run["activations"].items():
+                stats[f"activations/{name}"] = max(stats.get(f"activations/{name}", 0), value)
+
+        peak_key = "cuda_peak" if self.cuda else "cpu_rss_peak"
+        return {
+            "device": "cuda" if self.cuda else "cpu",
+            "capacity": self.capacity,
+            "model_params": self.model_bytes,
+            "peak": max([run[peak_key] for run in self.runs], default=0),
+            "per_length": {str(length): stats for length, stats in sorted(lengths.items(), key=lambda x: x[0] or 0)},
+            "runs": self.runs,
+        }
+
+    def write(self, path):
+        if not self.enabled:
+            return
+        with open(path, "w") as fout:
+            json.dump(self.summary(), fout, indent=2)
+
+    def __str__(self):
+        summary = self.summary()
+        lines = [f"peak memory ({summary['device']}): {_mb(summary['peak']):.1f}MB, model parameters: {_mb(summary['model_params']):.1f}MB"]
+        for length, stats in summary["per_length"].items():
+            lines.append(f"length {length}: " + "; ".join(f"{key}:{_mb(value):.1f}MB" for key, value in stats.items()))
+        return "\n".join(lines)
+
+
+def null_memory(name):
+    """stand-in for MemoryTracker.activations when nothing should be tracked (e.g. inside a compiled graph)"""
+    return nullcontext()
@@ -1,3 +1,6 @@
+import numpy as np
+import torch
+
 def get_epsilon(step, max_e, min_e, warmup_steps, cooldown_steps, decay_function):
     if decay_function == "none" or max_e == min_e:
         return max_e
@@ -20,7 +23,7 @@ def get_epsilon(step, max_e, min_e, warmup_steps, cooldown_steps, decay_function
         if step <= warmup_steps:
             return max_e
         elif step > warmup_steps and step <= cooldown_steps:
-            return max_e - (max_e - min_e) * ((cooldown_steps-warmup_steps+1) ** p/((cooldown_steps-warmup_steps+1)**p - 1)) * (1 - 1/(steps - warmup_steps + 1)**p)
+            return max_e - (max_e - min_e) * ((cooldown_steps-warmup_steps+1) ** p/((cooldown_steps-warmup_steps+1)**p - 1)) * (1 - 1/(step - warmup_steps + 1)**p)
         else:
             return min_e
     elif decay_function == "exponential":
@@ -37,6 +40,19 @@ def get_epsilon(step, max_e, min_e, warmup_steps, cooldown_steps, decay_function
         else:
             return min_e
 
+def get_epsilon_schedule(num_steps, max_es, min_es, warmup_steps, cooldown_steps, decay_functions, device="cpu"):
+    """
+    precomputes get_epsilon for every step (rows) and every constraint (columns).
+    Every schedule is constant after its warmup/cooldown, so the table covers at least that many steps and
+    later steps can use the last row (see epsilon_at)
+    """
+    num_steps = max([num_steps] + [w + 1 for w in warmup_steps] + [c + 1 for c in cooldown_steps]) + 1
+    schedule = [[get_epsilon(step, max_es[i], min_es[i], warmup_steps[i], cooldown_steps[i], decay_functions[i]) for i in range(len(max_es))] for step in range(num_steps)]
+    return torch.tensor(schedule, dtype=torch.float, device=device).view(num_steps, len(max_es))
+
+def epsilon_at(schedule, step):
+    return schedule[min(step, schedule.size(0) - 1)]
+
 # def plot_gd(losslist, filename="plot.png"):
 #     import matplotlib.pyplot as plt
 
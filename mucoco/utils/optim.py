@@ -293,7 +293,7 @@ class Optimizer(object):
             max_grad_norm = optim_opt.max_grad_norm,
             ascent=optim_opt.optim == "ascentsgd"
         )
-        if opt.model_dtype == "fp16":
+        if opt.model_dtype == "fp16" and opt.fp16_source == "apex": #with pytorch autocast, loss scaling is handled by the GradScaler passed to backward/step
             if opt.optim == "fusedadam":
                 optimizer._fp16 = "legacy"
             else:
@@ -1254,103 +1254,60 @@ class ExpGD(torch.optim.Optimizer):
         super(ExpGD, self).__setstate__(state)
 
     def step(self):
+        """
+        The exponentiated variants (mw=1,3,4,5) keep the log-probabilities as state and apply the update and the
+        renormalization over the vocabulary in the log domain: logp += exponand; logp -= logsumexp(logp); p = exp(logp).
+        This doesn't underflow for large learning rates and doesn't materialize exp(exponand) separately.
+        The multiplicative variants (mw=2,6 and any other value) multiply by 1 - lr * grad (1 - grad for mw=6), which can be zero or
+        negative when lr * grad >= 1, and the log domain can't represent that. So they stay in the probability domain, as one in-place
+        p += -lr * p * grad (addcmul, no temporary for the factor) followed by the renormalization.
+        mw=3,4,5 share a single auxiliary buffer (running mean of the gradients, last gradient and momentum respectively).
+        """
         loss = None
 
         for group in self.param_groups:
+            lr = group["lr"]
+            mw = group["mw"]
+            momentum = group['momentum']
+
             for parameter in group["params"]:
 
                 if parameter.grad is None:
                     continue
 
-                state = self.state[parameter]
-                lr = group["lr"]
                 gradient = parameter.grad.data
+                state = self.state[parameter]
 
-                mw = group["mw"]
-                momentum = group['momentum']
-
-                # print(parameter.size())
-                # print(gradient.size())
-                
-                # print(parameter)
-                if mw == 1:
-                    unnormalized = parameter.data.mul_(torch.exp(-lr * gradient))
-                    # print(unnormalized)
-                    parameter.data.div_(unnormalized.sum(dim=-1, keepdims=True))
-                    # print(-lr * gradient)
-                    # print(torch.exp(-lr * gradient))
-                    # print(parameter)
-                    # print(parameter.max(-1))
-                    # input()
-                elif mw == 3: # variation
-                    state = self.state[parameter]
-                    if len(state) == 0:
-                        state["step"] = 0
-                        state["mt"] = torch.zeros_like(gradient)
-                    mt = state['mt']
-                    step = state['step']
-                    exponand = -lr * gradient - 4 * lr * lr * (gradient - mt) ** 2
-                    unnormalized = parameter.data.mul_(torch.exp(exponand))
-                    # print(unnormalized)
-                    parameter.data.div_(unnormalized.sum(dim=-1, keepdims=True))
-
-                    mt = mt * step + gradient 
-                    mt = mt / (step + 1)
-                    state['step'] += 1
-                    state['mt'] = mt
-                elif mw == 4: #optimistic
-                    state = self.state[parameter]
-                    if len(state) == 0:
-                        state["step"] = 0
-                        state["zt"] = torch.zeros_like(gradient)
-                    zt = state['zt']
-                    step = state['step']
-
-                    exponand = -lr * gradient - lr * lr * (gradient - zt) ** 2
-                    unnormalized = parameter.data.mul_(torch.exp(exponand))
-                    # print(unnormalized)
-                    parameter.data.div_(unnormalized.sum(dim=-1, keepdims=True))
-
-                    state['step'] += 1
-                    state['zt'] = gradient
-                elif mw == 5: #momentum
-                    state = self.state[parameter]
-                    if len(state) == 0:
-                        state['step'] = 0
-                        state['lastgrad'] = torch.zeros_like(gradient)
-                    lastgrad = state['lastgrad']
-                    step = state['step']
-                    grad = (momentum * lastgrad + lr * gradient)
-                    unnormalized = parameter.data.mul_(torch.exp(-grad))
-                    # print(unnormalized)
-                    parameter.data.div_(unnormalized.sum(dim=-1, keepdims=True))
-
-                    state['step'] += 1
-                    state['lastgrad'] = grad
-                
-                elif mw == 6: #momentum with no exponent
-                    state = self.state[parameter]
-                    if len(state) == 0:
-                        state['step'] = 0
-                        state['lastgrad'] = torch.zeros_like(gradient)
-                    lastgrad = state['lastgrad']
-                    step = state['step']
-                    grad = (momentum * lastgrad + lr * gradient)
-                    unnormalized = parameter.data.mul_(1-gradient)
-                    # print(unnormalized)
+                if mw not in [1, 3, 4, 5]:
+                    # p * (1 - lr * grad), mw=6 (momentum with no exponent) uses a step of 1 and never reads the momentum
+                    unnormalized = parameter.data.addcmul_(parameter.data, gradient, value=-1.0 if mw == 6 else -lr)
                     parameter.data.div_(unnormalized.sum(dim=-1, keepdims=True))
+                    continue
 
-                    state['step'] += 1
-                    state['lastgrad'] = grad
-
-                else:
-                    unnormalized = parameter.data.mul_(1-lr * gradient)
-                    # print(unnormalized)
-                    parameter.data.div_(unnormalized.sum(dim=-1, keepdims=True))
-                
+                if len(state) == 0:
+                    state["step"] = 0
+                    state["logp"] = parameter.data.log()
+                    if mw in [3, 4, 5]:
+                        state["aux"] = torch.zeros_like(gradient)
+                logp = state["logp"]
+                aux = state.get("aux")
+                step = state["step"]
 
-                # print(parameter.size())
-                # print(parameter.data.sum(dim=-1))
-                # input()
+                if mw == 1:
+                    exponand = gradient.mul(-lr)
+                elif mw == 3: # variation, aux is the running mean of the gradients
+                    exponand = (gradient - aux).pow_(2).mul_(-4 * lr * lr).sub_(gradient, alpha=lr)
+                    aux.mul_(step / (step + 1)).add_(gradient, alpha=1 / (step + 1))
+                elif mw == 4: # optimistic, aux is the last gradient
+                    exponand = (gradient - aux).pow_(2).mul_(-lr * lr).sub_(gradient, alpha=lr)
+                    aux.copy_(gradient)
+                else: # momentum, aux is the accumulated update
+                    aux.mul_(momentum).add_(gradient, alpha=lr)
+                    exponand = aux.neg()
+
+                logp.add_(exponand)
+                logp.sub_(torch.logsumexp(logp, dim=-1, keepdim=True))
+                torch.exp(logp, out=parameter.data)
+                state["step"] += 1
 
         return loss
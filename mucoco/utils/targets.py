@@ -146,7 +146,7 @@ class TargetSimplex(nn.Module):
         
         pred_embs = []
         for embed_lut, embed_scale in zip(embed_luts, self.embed_scales):
-            pred_embs.append((pred_probs.unsqueeze(-1) * embed_lut.weight).sum(dim=-2))
+            pred_embs.append(pred_probs.matmul(embed_lut.weight))
         
         return (pred_embs, ), predictions, (pred_probs, softmax_pred_probs) #pred_probs is actually just logits
 
@@ -169,6 +169,10 @@ class TargetSimplex(nn.Module):
             # init_value = torch.empty_like(self._pred_logits).fill_(0.)
             # self._pred_logits.data.copy_(init_value.data)
 
+    def warm_start(self, previous, mode="append"):
+        # initialize from the optimized logits of another length (see _warm_start)
+        _warm_start(self._pred_logits, previous._pred_logits, mode)
+
     @classmethod
     def decode_beam(cls, pred_probs, model, embed_lut, prefix, device, beam_size=1):
         answers = []
@@ -291,11 +295,11 @@ class TargetProbability(nn.Module): #this is the class used in the final results
         pred_embs = []
         for embed_lut, embed_scale in zip(embed_luts, self.embed_scales):
             if embed_lut.weight.size(0) > pred_probs.size(2):
-                pred_embs.append((pred_probs.unsqueeze(-1) * embed_lut.weight[:pred_probs.size(2), :]).sum(dim=-2))
+                pred_embs.append(pred_probs.matmul(embed_lut.weight[:pred_probs.size(2), :]))
             elif embed_lut.weight.size(0) < pred_probs.size(2):
-                pred_embs.append((pred_probs[:, :, :embed_lut.weight.size(0)].unsqueeze(-1) * embed_lut.weight).sum(dim=-2))
+                pred_embs.append(pred_probs[:, :, :embed_lut.weight.size(0)].matmul(embed_lut.weight))
             else:
-                pred_embs.append((pred_probs.unsqueeze(-1) * embed_lut.weight).sum(dim=-2))
+                pred_embs.append(pred_probs.matmul(embed_lut.weight))
         
         return (pred_embs, ), predictions, (pred_probs, softmax_pred_probs) #pred_probs is actually just logits
 
@@ -318,6 +322,10 @@ class TargetProbability(nn.Module): #this is the class used in the final results
             torch.nn.init.ones_(self._pred_probs)
             self._pred_probs.data.div_(self._pred_probs.data.sum(dim=-1, keepdims=True))
 
+    def warm_start(self, previous, mode="append"):
+        # initialize from the optimized simplex of another length (see _warm_start)
+        _warm_start(self._pred_probs, previous._pred_probs, mode)
+
 class TargetEmbeddings(nn.Module): 
     def __init__(
         self,
@@ -427,6 +435,10 @@ class TargetEmbeddings(nn.Module):
             torch.nn.init.zeros_(self._pred_embeds)
             
         
+    def warm_start(self, previous, mode="append"):
+        # initialize from the optimized embeddings of another length (see _warm_start)
+        _warm_start(self._pred_embeds, previous._pred_embeds, mode)
+
     def printparams(self):
         print(self._pred_embeds)
 
@@ -444,4 +456,24 @@ def _emb_to_scores(metric, pred_emb, tgt_out_emb):
     else: # dot product
         return pred_emb.matmul(tgt_out_emb.t())
     
-    return scores
\ No newline at end of file
+    return scores
+
+
+def _warm_start(param, previous, mode="append"):
+    """
+    copies the solution of a previous length (B x L' x D) into a freshly initialized target (B x L x D).
+    append: the first min(L, L') positions are copied and any extra position at the end keeps its fresh initialization.
+    insert: same, but the last position of the previous solution stays the last one (e.g. the final punctuation),
+        the fresh positions are inserted right before it.
+    """
+    if param.size(0) != previous.size(0) or param.size(2) != previous.size(2):
+        raise ValueError(f"can't warm start a target of size {tuple(param.size())} from one of size {tuple(previous.size())}")
+
+    n = min(param.size(1), previous.size(1))
+    if mode == "append" or n < 2:
+        param.data[:, :n].copy_(previous.data[:, :n])
+    elif mode == "insert":
+        param.data[:, :n-1].copy_(previous.data[:, :n-1])
+        param.data[:, -1].copy_(previous.data[:, -1])
+    else:
+        raise ValueError(f"wrong warm start mode {mode}")
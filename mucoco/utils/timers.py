@@ -0,0 +1,80 @@
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+
+class StepTimers(object):
+    """
+    Wall clock timers for the phases of the decoding loop (forward, each loss, backward, optimizer steps, ...).
+    Times are accumulated per example and for the whole run and can be dumped to a JSON report.
+    When disabled, ``timers(phase)`` is a no-op context manager so it can stay in the hot loop.
+
+    Args:
+        enabled: whether to record anything
+        cuda: synchronize the GPU before reading the clock, otherwise the time of asynchronous kernels is attributed to the wrong phase
+    """
+
+    def __init__(self, enabled=False, cuda=False):
+        self.enabled = enabled
+        self.cuda = cuda
+        self.example = OrderedDict()
+        self.examples = []
+        self.run = OrderedDict()
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def __call__(self, phase):
+        if not self.enabled:
+            yield
+            return
+
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            elapsed = time.perf_counter() - start
+            for stats in [self.example, self.run]:
+                total, count = stats.get(phase, (0.0, 0))
+                stats[phase] = (total + elapsed, count + 1)
+
+    def end_example(self, **info):
+        """closes the timers of the current example, info (e.g. the example id) is stored alongside them in the report"""
+        if not self.enabled:
+            return
+        example = dict(info)
+        example["phases"] = _format(self.example)
+        self.examples.append(example)
+        self.example = OrderedDict()
+
+    def summary(self):
+        return {"run": _format(self.run), "examples": self.examples}
+
+    def write(self, path):
+        if not self.enabled:
+            return
+        with open(path, "w") as fout:
+            json.dump(self.summary(), fout, indent=2)
+
+    def __str__(self):
+        total_time = sum(total for total, _ in self.run.values())
+        lines = []
+        for phase, (total, count) in self.run.items():
+            lines.append(f"{phase}: {total:.3f}s in {count} calls ({1000 * total / count:.2f}ms/call, {100 * total / max(total_time, 1e-9):.1f}%)")
+        return "\n".join(lines)
+
+
+def null_timer(phase):
+    """stand-in for StepTimers when nothing should be timed (e.g. inside a compiled graph)"""
+    return nullcontext()
+
+
+def _format(stats):
+    return {phase: {"total": total, "count": count, "mean": total / count} for phase, (total, count) in stats.items()}
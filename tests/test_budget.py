@@ -0,0 +1,68 @@
+import torch
+
+from mucoco.utils.budget import BudgetAllocator
+
+
+def run_length(budget, violations, epsilon=0.1):
+    """runs a length until the allocator stops it, the constraint loss at every step comes from violations"""
+    budget.start_run()
+    step = 0
+    while budget.has_steps():
+        losses = [torch.tensor([1.0]), torch.tensor([violations(step) + epsilon])]
+        step += 1
+        if not budget.keep_going(step - 1, losses, [epsilon]):
+            break
+    budget.end_run()
+    return step
+
+
+def test_allocation_not_multiple_of_window():
+    budget = BudgetAllocator(3, 10, total_steps=75, window=10)
+    budget.start_example(2)
+    # the share of 25 steps is split between the two lengths
+    assert run_length(budget, lambda step: 0.0) == 12
+    assert run_length(budget, lambda step: 0.0) == 13
+    budget.end_example()
+    assert budget.examples[0]["base"] == 25
+    assert budget.examples[0]["steps"] == 25
+
+
+def test_extension_not_multiple_of_window():
+    budget = BudgetAllocator(3, 10, total_steps=75, window=10)
+    budget.end_example() # skipped, its share goes to the pool
+    budget.start_example(1)
+    # still improving when the 25 steps of the share run out: extended by a window as long as the pool allows it
+    steps = run_length(budget, lambda step: 1.0 / (step + 1))
+    budget.end_example()
+    assert steps == 45
+    assert budget.examples[1]["extended"] == 20
+    # the last example keeps its share
+    budget.start_example(1)
+    assert run_length(budget, lambda step: 1.0 / (step + 1)) == 25
+
+
+def test_stalled_run_is_withdrawn():
+    budget = BudgetAllocator(3, 10, total_steps=75, window=10)
+    budget.start_example(1)
+    assert run_length(budget, lambda step: 1.0) == 10
+    budget.end_example()
+    assert budget.examples[0]["withdrawn"] == 15
+
+
+def test_no_budget():
+    budget = BudgetAllocator(3, 7)
+    budget.start_example(2)
+    assert run_length(budget, lambda step: 1.0) == 7
+    assert run_length(budget, lambda step: 1.0 / (step + 1)) == 7
+
+
+def test_no_steps():
+    budget = BudgetAllocator(3, 0)
+    budget.start_example(1)
+    assert run_length(budget, lambda step: 1.0) == 0
+
+    # the budget is used up by the first example
+    budget = BudgetAllocator(2, 10, total_steps=1, window=10)
+    budget.start_example(1)
+    assert run_length(budget, lambda step: 1.0) == 0
+    budget.end_example()
@@ -0,0 +1,55 @@
+import pytest
+import torch
+
+from mucoco.utils.lambdas import Lambda
+from mucoco.utils.misc import get_epsilon, get_epsilon_schedule, epsilon_at
+
+
+def test_epsilon_schedule_matches_get_epsilon():
+    max_es = [0.9, 2.0, 1.0, 0.5, 3.0, 0.7]
+    min_es = [0.1, 0.5, 0.2, 0.5, 1.0, 0.3]
+    warmup_steps = [2, 0, 5, 1, 3, 4]
+    cooldown_steps = [10, 8, 30, 6, 12, 9]
+    decay_functions = ["linear", "rsqrt", "poly_2", "none", "exponential", "step"]
+    schedule = get_epsilon_schedule(20, max_es, min_es, warmup_steps, cooldown_steps, decay_functions)
+
+    # past the end of the table the schedules are constant
+    for step in range(50):
+        expected = [get_epsilon(step, max_es[i], min_es[i], warmup_steps[i], cooldown_steps[i], decay_functions[i]) for i in range(len(max_es))]
+        assert torch.allclose(epsilon_at(schedule, step), torch.tensor(expected, dtype=torch.float))
+
+
+@pytest.mark.parametrize("lr_decay_fn", [None, lambda step: 1.0 / step])
+def test_lambda_matches_per_constraint_loop(lr_decay_fn):
+    torch.manual_seed(0)
+    batch_size, count, dampness, lr = 4, 3, 10.0, 0.5
+    lambda_ = Lambda(count=count, lr=lr, lr_decay_fn=lr_decay_fn)
+    expected_lambda = [0.0] * count
+
+    for step in range(1, 6):
+        epsilons = torch.tensor([0.5, 1.0, 2.0])
+        losses = torch.rand(batch_size, count) * 3.0
+        # constraint 0 satisfied for every example, constraint 1 violated for every example, constraint 2 mixed
+        losses[:, 0] = 0.1
+        losses[:, 1] = 2.0 + step
+        slack = epsilons - losses
+        damp = dampness * slack
+
+        mask = lambda_.get_mask(damp)
+        closs = lambda_.get_loss(damp * mask, slack)
+        violation = -slack.sum(dim=0)
+
+        scale = 1.0 if lr_decay_fn is None else lr_decay_fn(step)
+        for i in range(count):
+            expected_mask = torch.tensor([0.0 if d >= 0 and expected_lambda[i] <= d else 1.0 for d in damp[:, i].tolist()])
+            expected_closs = (expected_lambda[i] - damp[:, i] * expected_mask) * slack[:, i]
+            assert torch.allclose(mask[:, i], expected_mask)
+            assert torch.allclose(closs[:, i], expected_closs)
+            expected_lambda[i] = max(0.0, expected_lambda[i] + scale * lr * violation[i].item())
+
+        lambda_.step(violation)
+        assert torch.allclose(lambda_(), torch.tensor(expected_lambda))
+
+    # satisfied constraints keep a zero multiplier, violated ones grow
+    assert lambda_()[0].item() == 0.0
+    assert lambda_()[1].item() > 0.0
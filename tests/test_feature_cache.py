@@ -0,0 +1,49 @@
+import torch
+
+from evaluation.formality.feature_cache import FeatureCache
+
+
+def add_features(cache, sentences, hidden=5):
+    torch.manual_seed(0)
+    pooled = torch.randn(len(sentences), hidden)
+    tokens = torch.randn(len(sentences), 4, hidden)
+    lengths = [len(sentence.split()) for sentence in sentences]
+    cache.add("cls", sentences, pooled)
+    cache.add("tokens", sentences, tokens, lengths)
+    cache.flush()
+    return pooled, tokens, lengths
+
+
+def test_reopened_cache_has_the_features(tmp_path):
+    sentences = ["a b c", "d", "e f g h", "a b c"]
+    cache = FeatureCache(str(tmp_path), "model", "fp32")
+    assert cache.missing(["cls", "tokens"], sentences) == ["a b c", "d", "e f g h"]
+    pooled, tokens, lengths = add_features(cache, sentences[:3])
+
+    # a later evaluation reads the shards written by the first one
+    cache = FeatureCache(str(tmp_path), "model", "fp32")
+    assert cache.missing(["cls", "tokens"], sentences) == []
+    assert torch.allclose(cache.vectors("cls", sentences, "cpu"), pooled[[0, 1, 2, 0]])
+
+    features, mask = cache.tokens(sentences, "cpu")
+    assert mask.sum(dim=-1).tolist() == [3, 1, 4, 3]
+    for i, j in enumerate([0, 1, 2, 0]):
+        assert torch.allclose(features[i, :lengths[j]], tokens[j, :lengths[j]])
+        assert features[i, lengths[j]:].abs().sum().item() == 0
+
+
+def test_flushes_are_merged(tmp_path):
+    cache = FeatureCache(str(tmp_path), "model", "fp32")
+    add_features(cache, ["a b", "c"])
+    other = FeatureCache(str(tmp_path), "model", "fp32")
+    add_features(other, ["d e f"])
+    assert FeatureCache(str(tmp_path), "model", "fp32").missing(["cls", "tokens"], ["a b", "c", "d e f"]) == []
+
+
+def test_other_model_or_dtype_misses(tmp_path):
+    sentences = ["a b c", "d"]
+    add_features(FeatureCache(str(tmp_path), "model", "fp32"), sentences)
+    assert FeatureCache(str(tmp_path), "other-model", "fp32").missing(["cls"], sentences) == sentences
+    assert FeatureCache(str(tmp_path), "model", "fp16").missing(["cls"], sentences) == sentences
+    # kinds which were not cached are missing too
+    assert FeatureCache(str(tmp_path), "model", "fp32").missing(["mean"], sentences) == sentences
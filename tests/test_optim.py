@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from mucoco.utils.optim import ExpGD
+
+
+def multiplicative_step(p, gradient, state, lr, mw, momentum):
+    """the update of ExpGD in the probability domain, as it was before the log domain state"""
+    if len(state) == 0:
+        state["step"] = 0
+        state["buffer"] = torch.zeros_like(gradient)
+    if mw == 1:
+        p = p * torch.exp(-lr * gradient)
+    elif mw == 3:
+        p = p * torch.exp(-lr * gradient - 4 * lr * lr * (gradient - state["buffer"]) ** 2)
+        state["buffer"] = (state["buffer"] * state["step"] + gradient) / (state["step"] + 1)
+    elif mw == 4:
+        p = p * torch.exp(-lr * gradient - lr * lr * (gradient - state["buffer"]) ** 2)
+        state["buffer"] = gradient
+    elif mw == 5:
+        state["buffer"] = momentum * state["buffer"] + lr * gradient
+        p = p * torch.exp(-state["buffer"])
+    elif mw == 6:
+        p = p * (1 - gradient)
+    else:
+        p = p * (1 - lr * gradient)
+    state["step"] += 1
+    return p / p.sum(dim=-1, keepdim=True)
+
+
+@pytest.mark.parametrize("mw", [1, 2, 3, 4, 5, 6])
+def test_expgd_matches_multiplicative_update(mw):
+    torch.manual_seed(0)
+    lr, momentum = 0.5, 0.9
+    p = torch.softmax(torch.randn(2, 3, 11, dtype=torch.double), dim=-1)
+    parameter = torch.nn.Parameter(p.clone())
+    optimizer = ExpGD([parameter], lr=lr, mw=mw, momentum=momentum)
+
+    state = {}
+    for _ in range(5):
+        # small gradients keep the multiplicative variants positive
+        gradient = 0.1 * torch.rand_like(p)
+        parameter.grad = gradient.clone()
+        optimizer.step()
+        p = multiplicative_step(p, gradient, state, lr, mw, momentum)
+        assert torch.allclose(parameter.data, p, rtol=1e-10, atol=1e-12)
+        assert torch.allclose(parameter.data.sum(dim=-1), torch.ones(2, 3, dtype=torch.double))
+
+
+def test_expgd_large_learning_rate():
+    # exp(-lr * gradient) underflows in the probability domain, the log domain keeps a distribution
+    parameter = torch.nn.Parameter(torch.full((1, 4), 0.25))
+    optimizer = ExpGD([parameter], lr=1000.0, mw=1)
+    parameter.grad = torch.tensor([[1.0, 2.0, 3.0, 4.0]])
+    optimizer.step()
+    assert torch.isfinite(parameter.data).all()
+    assert torch.allclose(parameter.data, torch.tensor([[1.0, 0.0, 0.0, 0.0]]))
+
+
+@pytest.mark.parametrize("mw", [2, 6])
+def test_expgd_multiplicative_negative_factor(mw):
+    # lr * gradient > 1 makes some coordinates negative, the multiplicative variants keep the update of the probability domain
+    torch.manual_seed(0)
+    lr = 50.0
+    p = torch.softmax(torch.randn(3, 7, dtype=torch.double), dim=-1)
+    parameter = torch.nn.Parameter(p.clone())
+    optimizer = ExpGD([parameter], lr=lr, mw=mw)
+
+    state = {}
+    for _ in range(3):
+        gradient = torch.rand_like(p) * (0.04 if mw == 2 else 1.5)
+        parameter.grad = gradient.clone()
+        optimizer.step()
+        p = multiplicative_step(p, gradient, state, lr, mw, 0.9)
+        assert torch.allclose(parameter.data, p, rtol=1e-10, atol=1e-12)
+    assert (parameter.data < 0).any()